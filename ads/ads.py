@@ -1,4 +1,5 @@
 import sys
+import threading
 
 
 class colors:
@@ -12,41 +13,68 @@ class colors:
     UNDERLINE = '\033[4m'
 
 
+# When a service is being handled on a worker thread, whatever it reports
+# is buffered here and replayed later (see _for_each_service)
+_reports = threading.local()
+
+
+def _emit(stream, text):
+    report = getattr(_reports, "buffer", None)
+    if report is not None:
+        report.append((stream, text))
+    else:
+        stream.write(text)
+        stream.flush()
+
+
 def debug(msg):
-    print(colors.OKBLUE + msg + colors.ENDC)
-    sys.stdout.flush()
+    _emit(sys.stdout, colors.OKBLUE + msg + colors.ENDC + "\n")
 
 
 def info(msg):
-    print(colors.OKGREEN + "--- " + msg + colors.ENDC)
-    sys.stdout.flush()
+    _emit(sys.stdout, colors.OKGREEN + "--- " + msg + colors.ENDC + "\n")
 
 
 def error(msg):
-    sys.stderr.write(colors.FAIL + "!!! " + msg + "\n" + colors.ENDC)
-    sys.stderr.flush()
+    _emit(sys.stderr, colors.FAIL + "!!! " + msg + "\n" + colors.ENDC)
+
+
+def error_output(output):
+    _emit(sys.stderr, output)
 
 
 def separator():
     return "--------------------------------"
 
 
-try:
-    import yaml
-except ImportError:
-    error(
-        "ads requires the python package 'pyyaml'.\n"
-        "Please install it with 'pip install pyyaml' or 'easy_install pyyaml'\n"
-        "(disregard the message about 'forcing --no-libyaml')")
-    sys.exit(1)
+# Modules that only some commands need (yaml, tempfile, subprocess, glob,
+# multiprocessing, httplib, the ones only logs uses...) are imported where
+# they're used, to keep startup fast. Every command parses its arguments,
+# so argparse is here.
 
 import os
-import tempfile
-import subprocess
+import stat
 import argparse
-import glob
 import time
-from collections import OrderedDict
+import marshal
+import fnmatch
+import select
+import fcntl
+import errno
+import atexit
+import re
+import itertools
+import operator
+from collections import deque
+
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        # Slower, but works
+        _scandir = None
 
 
 ##############################################
@@ -78,69 +106,604 @@ class Treelisting:
 
 
 ##############################################
-# subprocess stuff
+# Output multiplexing
 ##############################################
 
-def _shell_get_output(cmd_str, working_dir):
-    process = subprocess.Popen(
-        cmd_str,
-        shell=True,
-        stdout=subprocess.PIPE,
-        stderr=file("/dev/null", "w"),
-        close_fds=True,
-        cwd=working_dir)
+PREFIX_COLORS = ['\033[36m', '\033[35m', '\033[33m', '\033[34m',
+                 '\033[32m', '\033[96m', '\033[95m', '\033[93m']
+
+
+def _line_prefix(name, index, width):
+    return "%s%-*s%s | " % (PREFIX_COLORS[index % len(PREFIX_COLORS)],
+                            width, name, colors.ENDC)
+
+
+class _MuxStream:
+    # Lines longer than this are split rather than buffered forever
+    MAX_PARTIAL = 64 * 1024
+
+    def __init__(self, pipe, prefix, dest):
+        self.pipe = pipe
+        self.prefix = prefix
+        self.dest = dest
+        self.partial = ""
+
+    def feed(self, data):
+        lines = (self.partial + data).split("\n")
+        self.partial = lines.pop()
+        if len(self.partial) > self.MAX_PARTIAL:
+            lines.append(self.partial)
+            self.partial = ""
+        return "".join(self.prefix + line + "\n" for line in lines)
 
-    return process.communicate()[0]
+    def flush(self):
+        if not self.partial:
+            return ""
+        line = self.partial
+        self.partial = ""
+        return self.prefix + line + "\n"
 
 
+class OutputMux:
+    # Copies the output of any number of child processes to our stdout and
+    # stderr, a whole line at a time, each line prefixed with the name of
+    # the service it came from. A single thread reads every pipe as soon as
+    # it has data, so children never block on a full pipe.
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.streams = {}
+        (self.wake_r, self.wake_w) = os.pipe()
+        self.poller = hasattr(select, "poll") and select.poll() or None
+        if self.poller:
+            self.poller.register(self.wake_r, select.POLLIN)
+        self.thread = None
+
+    def add(self, pipe, prefix, dest):
+        fd = pipe.fileno()
+        fcntl.fcntl(fd, fcntl.F_SETFL,
+                    fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        with self.cond:
+            self.streams[fd] = _MuxStream(pipe, prefix, dest)
+            if self.poller:
+                self.poller.register(fd, select.POLLIN)
+            if not self.thread:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+        os.write(self.wake_w, "x")
+        return fd
+
+    def settle(self, fds):
+        # Call once the process that owns fds has exited. Copies whatever it
+        # left in them, and stops following them: anything still writing is
+        # something it backgrounded, and we don't wait for that.
+        with self.cond:
+            for fd in fds:
+                stream = self.streams.pop(fd, None)
+                if not stream:
+                    continue
+                if self.poller:
+                    self.poller.unregister(fd)
+                fcntl.fcntl(fd, fcntl.F_SETFL,
+                            fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+                (data, at_eof) = _drain_pipe(fd)
+                _write_whole(stream.dest, stream.feed(data) + stream.flush())
+                if at_eof:
+                    stream.pipe.close()
+                else:
+                    _hand_off_pipe(stream.pipe)
+
+    def _wait_readable(self, timeout):
+        if self.poller:
+            return [fd for (fd, _) in self.poller.poll(timeout * 1000)]
+        with self.cond:
+            fds = list(self.streams.keys())
+        return select.select(fds + [self.wake_r], [], [], timeout)[0]
+
+    def _run(self):
+        while True:
+            for fd in self._wait_readable(1.0):
+                if fd == self.wake_r:
+                    os.read(self.wake_r, 4096)
+                    continue
+                # Read (and write) under the lock so settle() can't hand the
+                # pipe off mid-read, or get its output out ahead of ours
+                with self.cond:
+                    stream = self.streams.get(fd)
+                    if not stream:
+                        continue
+                    try:
+                        data = os.read(fd, 65536)
+                    except OSError as e:
+                        if e.errno in (errno.EAGAIN, errno.EINTR):
+                            continue
+                        data = ""
+                    if data:
+                        text = stream.feed(data)
+                    else:
+                        text = stream.flush()
+                        del self.streams[fd]
+                        if self.poller:
+                            self.poller.unregister(fd)
+                        stream.pipe.close()
+                    _write_whole(stream.dest, text)
+
+
+def _write_whole(dest, text):
+    if text:
+        dest.write(text)
+        dest.flush()
+
+
+_output_mux = []
+_output_mux_lock = threading.Lock()
+
+
+def _get_output_mux():
+    with _output_mux_lock:
+        if not _output_mux:
+            _output_mux.append(OutputMux())
+        return _output_mux[0]
+
+
+##############################################
+# subprocess stuff
+##############################################
+
 STREAM = "stream"
 BUFFER = "buffer"
 NULL = "null"
 
 
+# Captured output stays in memory unless it gets bigger than this
+BUFFER_SPILL_SIZE = 1024 * 1024
+
+# Scripts are passed to bash in the environment unless they're bigger than
+# this (the OS limits the size of a single variable). Not as an argument:
+# then "pgrep -f" in the script would find bash itself.
+MAX_INLINE_SCRIPT = 64 * 1024
+INLINE_SCRIPT_VAR = "ADS_SCRIPT"
+RUN_INLINE_SCRIPT = ('__ads_script="$%s"; unset %s; eval "$__ads_script"' %
+                     (INLINE_SCRIPT_VAR, INLINE_SCRIPT_VAR))
+
+CAPTURE_POLL_INTERVAL = 0.05
+
+
+def _hand_off_pipe(pipe):
+    # A backgrounded grandchild still holds the write end of one of our
+    # pipes. Rather than have it die of SIGPIPE when we exit, give the pipe
+    # to a detached process that discards whatever it writes from now on.
+    import subprocess
+    devnull = open(os.devnull, "w")
+    subprocess.Popen(["cat"],
+                     stdin=pipe,
+                     stdout=devnull,
+                     stderr=devnull,
+                     close_fds=True,
+                     preexec_fn=os.setsid)
+    devnull.close()
+    pipe.close()
+
+
+def _drain_pipe(fd):
+    # Reads what's in the pipe right now, but not anything written to it
+    # after that, so a chatty writer can't keep us here. Returns (data,
+    # whether the pipe is at EOF).
+    import array
+    import termios
+    available = array.array("i", [0])
+    fcntl.ioctl(fd, termios.FIONREAD, available, True)
+    chunks = []
+    left = available[0]
+    while left > 0:
+        data = os.read(fd, left)
+        if not data:
+            break
+        chunks.append(data)
+        left -= len(data)
+    # Readable with nothing in it means EOF
+    readable = select.select([fd], [], [], 0)[0]
+    fcntl.ioctl(fd, termios.FIONREAD, available, True)
+    return ("".join(chunks), bool(readable) and not available[0])
+
+
+def _capture_output(process):
+    # Reads process's (merged) output until it exits. Doesn't wait for EOF,
+    # which never comes if the command backgrounded something.
+    import tempfile
+    out = tempfile.SpooledTemporaryFile(max_size=BUFFER_SPILL_SIZE)
+    fd = process.stdout.fileno()
+    while True:
+        if process.poll() is not None:
+            # Whatever it wrote is in the pipe by now; anything after that
+            # is from something it backgrounded
+            (data, at_eof) = _drain_pipe(fd)
+            out.write(data)
+            if at_eof:
+                process.stdout.close()
+            else:
+                _hand_off_pipe(process.stdout)
+            break
+        if select.select([fd], [], [], CAPTURE_POLL_INTERVAL)[0]:
+            data = os.read(fd, 65536)
+            if not data:
+                process.stdout.close()
+                break
+            out.write(data)
+    status = process.wait()
+    out.seek(0)
+    output = out.read()
+    out.close()
+    return status, output
+
+
+class _BashScript:
+    # A script for bash to run, and how to hand it over
+    def __init__(self, script):
+        if len(script) <= MAX_INLINE_SCRIPT:
+            self.cmd_file = None
+            self.args = ["/bin/bash", "-c", RUN_INLINE_SCRIPT]
+            self.env = dict(os.environ)
+            self.env[INLINE_SCRIPT_VAR] = script
+        else:
+            import tempfile
+            self.cmd_file = tempfile.NamedTemporaryFile()
+            self.cmd_file.write(script)
+            self.cmd_file.flush()
+            self.args = ["/bin/bash", self.cmd_file.name]
+            self.env = None
+
+    def spawn(self, working_dir, stdout, stderr):
+        import subprocess
+        return subprocess.Popen(self.args,
+                                close_fds=True,
+                                cwd=working_dir,
+                                env=self.env,
+                                stdout=stdout,
+                                stderr=stderr)
+
+    def close(self):
+        if self.cmd_file:
+            self.cmd_file.close()
+
+
+def _command_script(cmd_str, working_dir):
+    return """
+echo 'cd %s'
+cat <<ADS_EOF
+%s
+ADS_EOF
+%s
+""" % (working_dir, cmd_str, cmd_str)
+
+
 def _shell(cmd_str, working_dir, output_mode=STREAM):
+    import subprocess
+    # Set when this service is one of several being handled concurrently
+    line_prefix = getattr(_reports, "prefix", None)
+
+    if _shell_pool:
+        return _shell_pool[0].run(cmd_str, working_dir, output_mode,
+                                  line_prefix)
+
     if output_mode == STREAM:
-        out_file = None
+        out_file = line_prefix and subprocess.PIPE or None
     elif output_mode == BUFFER:
-        out_file = tempfile.NamedTemporaryFile()
+        out_file = subprocess.PIPE
     elif output_mode == NULL:
         out_file = open(os.devnull, 'w')
     else:
-        raise Error("Unknown output_mode '%s'" % output_mode)
+        raise ValueError("Unknown output_mode '%s'" % output_mode)
 
-    # Write the command into a file and invoke bash on it
-    cmd_file = tempfile.NamedTemporaryFile()
-    cmd_file.write("""
-echo 'cd %s'
-cat <<ADS_EOF
-%s
-ADS_EOF
-%s
-""" % (working_dir, cmd_str, cmd_str))
-    cmd_file.flush()
+    script = _BashScript(_command_script(cmd_str, working_dir))
+
+    output = None
     try:
-        status = subprocess.Popen(
-            ["/bin/bash", cmd_file.name],
-            close_fds=True,
-            cwd=working_dir,
-            # Same file for stdout and stderr to preserve order (roughly)
-            stdout=out_file,
-            stderr=out_file).wait()
+        if output_mode == BUFFER:
+            # Same pipe for stdout and stderr to preserve order
+            process = script.spawn(working_dir,
+                                   subprocess.PIPE, subprocess.STDOUT)
+            (status, output) = _capture_output(process)
+        else:
+            process = script.spawn(working_dir, out_file, out_file)
+            if out_file == subprocess.PIPE:
+                mux = _get_output_mux()
+                fds = [mux.add(process.stdout, line_prefix, sys.stdout),
+                       mux.add(process.stderr, line_prefix, sys.stderr)]
+                status = process.wait()
+                mux.settle(fds)
+            else:
+                status = process.wait()
     except KeyboardInterrupt:
         # Suppress python from printing a stack trace
         status = 47
         pass
-    cmd_file.close()
+    script.close()
+    if output_mode == NULL:
+        out_file.close()
 
     if output_mode == BUFFER:
-        out_file.seek(0)
-        output = out_file.read()
-        out_file.close()
-        return status, output
+        return status, output or ""
     else:
         return status, None
 
 
+def _sh_quote(s):
+    return "'" + s.replace("'", "'\\''") + "'"
+
+
+def _probe_batch(probes):
+    # Runs each (cmd_str, working_dir) probe in a subshell of one bash, with
+    # output discarded, and returns their exit statuses. The statuses come
+    # back on the original stdout (fd 3), one framed line per probe.
+    import subprocess
+    import random
+    nonce = "ads-probe-%d-%d" % (os.getpid(), random.randint(0, 1 << 30))
+    lines = ["exec 3>&1 1>/dev/null 2>&1 </dev/null"]
+    for (i, (cmd_str, working_dir)) in enumerate(probes):
+        lines.append(
+            "(exec 3>&-; cd %s && eval %s); printf '%s %d %%d\\n' $? >&3" %
+            (_sh_quote(working_dir), _sh_quote(cmd_str), nonce, i))
+    script = _BashScript("\n".join(lines) + "\n")
+    try:
+        output = _capture_output(
+            script.spawn(os.curdir, subprocess.PIPE, subprocess.PIPE))[1]
+    finally:
+        script.close()
+
+    statuses = [None] * len(probes)
+    for line in output.splitlines():
+        frame = line.split(" ")
+        if len(frame) == 3 and frame[0] == nonce:
+            statuses[int(frame[1])] = int(frame[2])
+    return statuses
+
+
+def _probe_all(probes, workers):
+    # _probe_batch, split across up to workers bash processes
+    if not probes:
+        return []
+    workers = max(1, min(workers, len(probes)))
+    chunk_size = (len(probes) + workers - 1) // workers
+    chunks = [probes[i:i + chunk_size]
+              for i in range(0, len(probes), chunk_size)]
+    results = [None] * len(chunks)
+
+    def probe_chunk(i):
+        results[i] = _probe_batch(chunks[i])
+
+    threads = [threading.Thread(target=probe_chunk, args=(i,))
+               for i in range(1, len(chunks))]
+    for t in threads:
+        t.start()
+    probe_chunk(0)
+    for t in threads:
+        t.join()
+    return [status for chunk_result in results for status in chunk_result]
+
+
+##############################################
+# Shell worker pool
+##############################################
+
+SHELL_ENGINES = ["process", "pool"]
+SHELL_POOL_SIZE = 8
+
+
+def _release_pipe(pipe):
+    # For a pipe whose writer has exited: if it's at EOF, close it,
+    # otherwise someone else still holds it, so hand it off
+    if _drain_pipe(pipe.fileno())[1]:
+        pipe.close()
+    else:
+        _hand_off_pipe(pipe)
+
+
+class _ShellWorker:
+    # A warm bash reading commands from its stdin. Each command runs in a
+    # subshell (so cd, exit, etc. can't affect the worker), and then the
+    # worker prints a sentinel line carrying its exit status:
+    #   <nonce> <seq> <status>\n
+    # Commands get /dev/null for stdin, since stdin is our channel, and a
+    # FIFO of their own for output, so that anything they leave running in
+    # the background can't write into the channel either.
+
+    def __init__(self):
+        import subprocess
+        import random
+        import tempfile
+        self.process = subprocess.Popen(["/bin/bash"],
+                                        close_fds=True,
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=open(os.devnull, "w"))
+        self.nonce = "ads-worker-%d-%d" % (os.getpid(),
+                                           random.randint(0, 1 << 30))
+        self.seq = 0
+        self.fifo_dir = tempfile.mkdtemp(prefix="ads-worker-")
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def _open_fifo(self):
+        # Returns (path, read fd, write fd). We hold a write end ourselves
+        # until the command is done, so reads never see a premature EOF.
+        path = os.path.join(self.fifo_dir, "out-%d" % self.seq)
+        os.mkfifo(path)
+        read_fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        write_fd = os.open(path, os.O_WRONLY)
+        # Only read after select says so; and whoever inherits it in
+        # _release_pipe expects blocking reads
+        fcntl.fcntl(read_fd, fcntl.F_SETFL,
+                    fcntl.fcntl(read_fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+        return (path, read_fd, write_fd)
+
+    def run(self, cmd_str, working_dir, output_mode, emit):
+        self.seq += 1
+        if output_mode == NULL:
+            out = None
+            redirect = ">/dev/null 2>&1"
+        else:
+            out = self._open_fifo()
+            redirect = ">%s 2>&1" % _sh_quote(out[0])
+        try:
+            self.process.stdin.write(
+                "(cd %s && eval %s) %s </dev/null\n"
+                "printf '%s %d %%d\\n' $?\n" %
+                (_sh_quote(working_dir),
+                 _sh_quote(_command_script(cmd_str, working_dir)),
+                 redirect, self.nonce, self.seq))
+            self.process.stdin.flush()
+            return self._wait(out and out[1], emit)
+        except IOError:
+            # The worker died (maybe the last command killed it)
+            return 1
+        finally:
+            if out:
+                os.unlink(out[0])
+                os.close(out[2])
+                _release_pipe(os.fdopen(out[1], "rb"))
+
+    def _wait(self, out_fd, emit):
+        # Passes output on until the sentinel comes, then whatever output
+        # is left
+        sentinel = "%s %d " % (self.nonce, self.seq)
+        channel = self.process.stdout.fileno()
+        fds = [channel] + (out_fd is not None and [out_fd] or [])
+        pending = ""
+        while True:
+            for fd in select.select(fds, [], [])[0]:
+                data = os.read(fd, 65536)
+                if fd == out_fd:
+                    emit(data)
+                    continue
+                if not data:
+                    # The worker died (maybe the command killed it)
+                    self._drain(out_fd, emit)
+                    return 1
+                pending += data
+                found = pending.find(sentinel)
+                if found >= 0:
+                    end = pending.find("\n", found)
+                    if end >= 0:
+                        self._drain(out_fd, emit)
+                        return int(pending[found + len(sentinel):end])
+
+    def _drain(self, out_fd, emit):
+        while out_fd is not None and select.select([out_fd], [], [], 0)[0]:
+            emit(os.read(out_fd, 65536))
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
+        self.process.wait()
+        _release_pipe(self.process.stdout)
+        try:
+            os.rmdir(self.fifo_dir)
+        except OSError:
+            pass
+
+
+class ShellPool:
+    # Runs _shell commands on up to max_workers warm bash workers rather than
+    # starting a new bash for each one. Dead workers are replaced on the way
+    # out of the pool.
+
+    def __init__(self, max_workers=SHELL_POOL_SIZE):
+        self.max_workers = max_workers
+        self.idle = []
+        self.count = 0
+        self.cond = threading.Condition()
+
+    def _checkout(self):
+        with self.cond:
+            while True:
+                while self.idle:
+                    worker = self.idle.pop()
+                    if worker.is_alive():
+                        return worker
+                    self.count -= 1
+                    worker.close()
+                if self.count < self.max_workers:
+                    self.count += 1
+                    break
+                self.cond.wait(0.1)
+        try:
+            return _ShellWorker()
+        except:
+            with self.cond:
+                self.count -= 1
+            raise
+
+    def _checkin(self, worker):
+        alive = worker.is_alive()
+        if not alive:
+            # Cleans up its FIFO directory
+            worker.close()
+        with self.cond:
+            if alive:
+                self.idle.append(worker)
+            else:
+                self.count -= 1
+            self.cond.notify()
+
+    def run(self, cmd_str, working_dir, output_mode, line_prefix=None):
+        if output_mode == BUFFER:
+            import tempfile
+            out = tempfile.SpooledTemporaryFile(max_size=BUFFER_SPILL_SIZE)
+            emit = out.write
+        elif output_mode == STREAM:
+            lines = _MuxStream(None, line_prefix or "", sys.stdout)
+            emit = lambda data: _write_whole(sys.stdout, lines.feed(data))
+        elif output_mode == NULL:
+            emit = lambda data: None
+        else:
+            raise ValueError("Unknown output_mode '%s'" % output_mode)
+
+        worker = self._checkout()
+        try:
+            status = worker.run(cmd_str, working_dir, output_mode, emit)
+        except KeyboardInterrupt:
+            # Suppress python from printing a stack trace. The worker is
+            # mid-command, so it can't be reused.
+            worker.process.kill()
+            status = 47
+        finally:
+            self._checkin(worker)
+
+        if output_mode == STREAM:
+            _write_whole(sys.stdout, lines.flush())
+            return status, None
+        elif output_mode == BUFFER:
+            out.seek(0)
+            output = out.read()
+            out.close()
+            return status, output
+        else:
+            return status, None
+
+    def close(self):
+        with self.cond:
+            workers = self.idle
+            self.idle = []
+            self.count = 0
+        for worker in workers:
+            worker.close()
+
+
+# Holds the ShellPool when that engine is in use
+_shell_pool = []
+
+
+def _use_shell_engine(engine):
+    if engine == "pool" and not _shell_pool:
+        _shell_pool.append(ShellPool())
+        atexit.register(_shell_pool[0].close)
+
+
 ##############################################
 # YML stuff
 ##############################################
@@ -157,12 +720,283 @@ def _expect(expected_type, actual, origin_file):
             (origin_file, str(expected_type), type(actual), str(actual)))
 
 
+def _load_jobs(spec, origin_file):
+    jobs = spec.get("jobs")
+    if jobs is None:
+        return None
+    _expect(int, jobs, origin_file)
+    if jobs < 1:
+        raise ParseProjectException(
+            "%s: jobs must be at least 1, got %d" % (origin_file, jobs))
+    return jobs
+
+
+def _load_shell_engine(spec, origin_file):
+    engine = spec.get("shell_engine")
+    if engine is None:
+        return None
+    _expect(str, engine, origin_file)
+    if engine not in SHELL_ENGINES:
+        raise ParseProjectException(
+            "%s: shell_engine must be one of %s, got %s" %
+            (origin_file, ", ".join(SHELL_ENGINES), engine))
+    return engine
+
+
+def _load_timeout(spec, key, default, origin_file):
+    timeout = spec.get(key)
+    if timeout is None:
+        return default
+    _expect((int, float), timeout, origin_file)
+    if timeout < 0:
+        raise ParseProjectException(
+            "%s: %s can't be negative, got %s" % (origin_file, key, timeout))
+    return timeout
+
+
+def _import_yaml():
+    # Slowest import by far, and only needed when a spec isn't cached
+    try:
+        import yaml
+    except ImportError:
+        error(
+            "ads requires the python package 'pyyaml'.\n"
+            "Please install it with 'pip install pyyaml' or "
+            "'easy_install pyyaml'")
+        sys.exit(1)
+    return yaml
+
+
 def _load_spec_file(path):
-    result = yaml.safe_load(file(path, "r").read()) or {}
+    yaml = _import_yaml()
+    # libyaml's loader is many times faster, when pyyaml was built with it
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    result = yaml.load(file(path, "r").read(), Loader=loader) or {}
     _expect(dict, result, path)
     return result
 
 
+##############################################
+# Status checks
+##############################################
+
+STATUS_CHECK_TIMEOUT = 2
+
+
+def _pidfile_ok(path):
+    try:
+        pid = int(file(path, "r").read().strip())
+    except (IOError, ValueError):
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        # EPERM means it exists but belongs to somebody else
+        return e.errno == errno.EPERM
+    return True
+
+
+def _tcp_port_ok(host, port):
+    import socket
+    try:
+        socket.create_connection((host, port), STATUS_CHECK_TIMEOUT).close()
+    except (socket.error, socket.timeout):
+        return False
+    return True
+
+
+def _http_ok(url, expected_status):
+    import socket
+    import httplib
+    import urlparse
+    parsed = urlparse.urlsplit(url)
+    if parsed.scheme == "https":
+        conn_class = httplib.HTTPSConnection
+    else:
+        conn_class = httplib.HTTPConnection
+    path = parsed.path or "/"
+    if parsed.query:
+        path = path + "?" + parsed.query
+    try:
+        conn = conn_class(parsed.netloc, timeout=STATUS_CHECK_TIMEOUT)
+        try:
+            conn.request("GET", path)
+            return conn.getresponse().status == expected_status
+        finally:
+            conn.close()
+    except (socket.error, socket.timeout, httplib.HTTPException):
+        return False
+
+
+REGEX_CHARS = frozenset(".^$*+?{}[]\\|()")
+
+
+class ProcessTable:
+    # A snapshot of every process's command line, read once and shared by
+    # all the process_pattern checks that run until it's invalidated
+
+    @classmethod
+    def read(cls):
+        if os.path.isdir("/proc"):
+            return ProcessTable(ProcessTable._read_proc())
+        else:
+            # No procfs (Mac OS); one ps is still better than a pgrep each
+            return ProcessTable(ProcessTable._read_ps())
+
+    @staticmethod
+    def _read_proc():
+        processes = []
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                cmdline = file("/proc/%s/cmdline" % entry, "r").read()
+            except IOError:
+                # Exited while we were looking
+                continue
+            processes.append((int(entry), cmdline.replace("\0", " ")))
+        return processes
+
+    @staticmethod
+    def _read_ps():
+        import subprocess
+        ps = subprocess.Popen(["ps", "-A", "-ww", "-o", "pid=", "-o", "args="],
+                              stdout=subprocess.PIPE)
+        processes = []
+        for line in ps.communicate()[0].splitlines():
+            (pid, _, cmdline) = line.strip().partition(" ")
+            if int(pid) != ps.pid:
+                processes.append((int(pid), cmdline))
+        return processes
+
+    def __init__(self, processes):
+        # Like pgrep -f, we never match ourselves
+        self.processes = [(pid, cmdline.replace("\n", " ").strip())
+                          for (pid, cmdline) in processes
+                          if pid != os.getpid()]
+        self.blob = "\n".join([c for (_, c) in self.processes])
+        self.matches = {}
+        self.read_at = time.time()
+
+    def has_match(self, pattern):
+        if pattern not in self.matches:
+            if REGEX_CHARS.isdisjoint(pattern):
+                # Plain substring: one scan over everything at once
+                found = pattern in self.blob
+            else:
+                regex = re.compile(pattern)
+                found = any(regex.search(c) for (_, c) in self.processes)
+            self.matches[pattern] = found
+        return self.matches[pattern]
+
+
+_process_table = []
+_process_table_lock = threading.Lock()
+
+
+def _get_process_table():
+    with _process_table_lock:
+        if not _process_table:
+            _process_table.append(ProcessTable.read())
+        return _process_table[0]
+
+
+def _invalidate_process_table(max_age=None):
+    # Call with no max_age after running anything that might start or stop
+    # processes. Pollers pass one, so concurrent pollers share a snapshot.
+    with _process_table_lock:
+        if _process_table and (max_age is None or
+                               _process_table[0].read_at <
+                               time.time() - max_age):
+            del _process_table[:]
+
+
+def _process_pattern_ok(pattern):
+    return _get_process_table().has_match(pattern)
+
+
+class StatusCheck:
+    # The status: block of an ads.yml. Checked in-process rather than by
+    # running a command; the service is up if every listed check passes.
+
+    KEYS = ["pidfile", "tcp_port", "http_url", "http_status",
+            "process_pattern"]
+
+    @classmethod
+    def load(cls, spec, origin_file):
+        _expect(dict, spec, origin_file)
+        for key in spec:
+            if key not in StatusCheck.KEYS:
+                raise ParseProjectException(
+                    "%s: Unknown key in status: %s (expected one of %s)" %
+                    (origin_file, key, ", ".join(StatusCheck.KEYS)))
+
+        tcp_port = spec.get("tcp_port")
+        if isinstance(tcp_port, str) and ":" in tcp_port:
+            (host, port) = tcp_port.rsplit(":", 1)
+            if not port.isdigit():
+                raise ParseProjectException(
+                    "%s: tcp_port must be a port or host:port, got %s" %
+                    (origin_file, tcp_port))
+            tcp_port = (host, int(port))
+        elif tcp_port is not None:
+            _expect(int, tcp_port, origin_file)
+            tcp_port = ("127.0.0.1", tcp_port)
+
+        for key in ["pidfile", "http_url", "process_pattern"]:
+            if spec.get(key) is not None:
+                _expect(str, spec[key], origin_file)
+        if spec.get("http_status") is not None:
+            _expect(int, spec["http_status"], origin_file)
+
+        if spec.get("process_pattern") is not None:
+            try:
+                re.compile(spec["process_pattern"])
+            except re.error as e:
+                raise ParseProjectException(
+                    "%s: Bad process_pattern: %s" % (origin_file, e))
+
+        result = StatusCheck(spec.get("pidfile"),
+                             tcp_port,
+                             spec.get("http_url"),
+                             spec.get("http_status"),
+                             spec.get("process_pattern"))
+        if not result.checks:
+            raise ParseProjectException(
+                "%s: status needs at least one of pidfile, tcp_port, "
+                "http_url or process_pattern" % origin_file)
+        return result
+
+    def __init__(self, pidfile=None, tcp_port=None, http_url=None,
+                 http_status=None, process_pattern=None):
+        self.checks = []
+        if pidfile:
+            self.checks.append(("pidfile " + pidfile,
+                                lambda home: _pidfile_ok(
+                                    os.path.join(home, pidfile))))
+        if tcp_port:
+            self.checks.append(("tcp_port %s:%d" % tcp_port,
+                                lambda home: _tcp_port_ok(*tcp_port)))
+        if http_url:
+            expected = http_status or 200
+            self.checks.append(("http_url %s (expecting %d)" %
+                                (http_url, expected),
+                                lambda home: _http_ok(http_url, expected)))
+        if process_pattern:
+            self.checks.append(("process_pattern " + process_pattern,
+                                lambda home: _process_pattern_ok(
+                                    process_pattern)))
+
+    def is_running(self, home, verbose=False):
+        for (description, check) in self.checks:
+            ok = check(home)
+            if verbose:
+                debug("%s: %s" % (description, ok and "ok" or "failed"))
+            if not ok:
+                return False
+        return True
+
+
 ##############################################
 # Service
 ##############################################
@@ -171,10 +1005,46 @@ def _abs_to_cwd_rel(abspath):
     return os.path.relpath(abspath, os.path.abspath(os.curdir))
 
 
+# How long to wait after stop_cmd for status to say it worked
+DEFAULT_STOP_TIMEOUT = 5
+
+
+def _load_ready_log_pattern(spec, origin_file):
+    pattern = spec.get("ready_log_pattern")
+    if pattern is None:
+        return None
+    _expect(str, pattern, origin_file)
+    if not spec.get("log_paths"):
+        raise ParseProjectException(
+            "%s: ready_log_pattern needs log_paths to look in" % origin_file)
+    try:
+        re.compile(pattern)
+    except re.error as e:
+        raise ParseProjectException(
+            "%s: Bad ready_log_pattern: %s" % (origin_file, e))
+    return pattern
+
+
+def _load_timestamp_formats(spec, origin_file):
+    formats = spec.get("log_timestamp_format")
+    if formats is None:
+        return None
+    if not isinstance(formats, list):
+        formats = [formats]
+    for fmt in formats:
+        _expect(str, fmt, origin_file)
+        try:
+            time.strftime(fmt, _TIMESTAMP_SAMPLE)
+        except ValueError as e:
+            raise ParseProjectException(
+                "%s: Bad log_timestamp_format %s: %s" % (origin_file, fmt, e))
+    return formats
+
+
 class Service:
     @classmethod
-    def load(cls, svc_yml, name):
-        spec = _load_spec_file(svc_yml)
+    def load(cls, svc_yml, name, load_spec=_load_spec_file):
+        spec = load_spec(svc_yml)
         return Service(name,
                        os.path.dirname(svc_yml),
                        spec.get("description"),
@@ -182,7 +1052,14 @@ class Service:
                        spec.get("stop_cmd"),
                        spec.get("status_cmd"),
                        spec.get("log_paths"),
-                       spec.get("err_log_paths"))
+                       spec.get("err_log_paths"),
+                       spec.get("status") is not None and
+                       StatusCheck.load(spec["status"], svc_yml) or None,
+                       spec.get("force_stop_cmd"),
+                       _load_timeout(spec, "stop_timeout",
+                                     DEFAULT_STOP_TIMEOUT, svc_yml),
+                       _load_ready_log_pattern(spec, svc_yml),
+                       _load_timestamp_formats(spec, svc_yml))
 
     @classmethod
     def as_printable_dict(cls, services):
@@ -191,7 +1068,9 @@ class Service:
 
     def __init__(self, name, home, description=None,
                  start_cmd=None, stop_cmd=None, status_cmd=None,
-                 log_paths=None, err_log_paths=None):
+                 log_paths=None, err_log_paths=None, status_check=None,
+                 force_stop_cmd=None, stop_timeout=DEFAULT_STOP_TIMEOUT,
+                 ready_log_pattern=None, log_timestamp_formats=None):
 
         self.name = name
         self.home = home
@@ -200,25 +1079,34 @@ class Service:
         self.start_cmd = start_cmd
         self.stop_cmd = stop_cmd
         self.status_cmd = status_cmd
+        self.status_check = status_check
+        self.force_stop_cmd = force_stop_cmd
+        self.stop_timeout = stop_timeout
+        self.ready_log_pattern = ready_log_pattern
+        self.log_timestamp_formats = log_timestamp_formats
 
         self.log_paths = log_paths or []
         self.err_log_paths = err_log_paths or []
 
-    def resolve_logs_relative_to_cwd(self, log_type):
+    def get_log_globs(self, log_type):
         if log_type == "general":
             log_paths = self.log_paths
         elif log_type == "error":
             log_paths = self.err_log_paths
         else:
             assert False, "Unknown log_type %s" % log_type
+        return [os.path.join(self.home, logfile) for logfile in log_paths]
 
+    def resolve_logs_relative_to_cwd(self, log_type, with_rotated=False):
+        import glob
         result = []
-        for logfile in log_paths:
-            abs_log_glob = os.path.join(self.home, logfile)
+        for abs_log_glob in self.get_log_globs(log_type):
             result = result + [
                 _abs_to_cwd_rel(abs_log_file)
                 for abs_log_file
                 in glob.iglob(abs_log_glob)]
+        if with_rotated:
+            result = _with_rotated(result)
         return result
 
     def resolve_home_relative_to_cwd(self):
@@ -227,6 +1115,33 @@ class Service:
     def get_description_or_default(self):
         return self.description or "(No description)"
 
+    def can_check_status(self):
+        return bool(self.status_check or self.status_cmd)
+
+    def __repr__(self):
+        return self.name
+
+
+class LazyService(object):
+    # Stands in for a Service whose ads.yml hasn't been parsed yet. The name
+    # and home come from the path; anything else parses it.
+
+    def __init__(self, svc_yml, name, load_spec=_load_spec_file):
+        self.svc_yml = svc_yml
+        self.name = name
+        self.home = os.path.dirname(svc_yml)
+        self.load_spec = load_spec
+        self.service = None
+
+    def load(self):
+        if not self.service:
+            self.service = Service.load(self.svc_yml, self.name,
+                                        self.load_spec)
+        return self.service
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
     def __repr__(self):
         return self.name
 
@@ -240,35 +1155,177 @@ class BadSelectorException(Exception):
         super(BadSelectorException, self).__init__(msg)
 
 
-def _resolve(selector, project, service_sets_by_name, selector_stack):
-    assert selector
+def _parse_selector(selector):
+    # A selector is whitespace-separated terms, each a union ("|") of
+    # intersections ("&") of names; a leading "-" excludes the term instead.
+    # "all -slow-batch" -> [(False, [["all"]]), (True, [["slow-batch"]])]
+    terms = []
+    for term in selector.split():
+        excluded = term.startswith("-")
+        if excluded:
+            term = term[1:]
+        union = [alternative.split("&") for alternative in term.split("|")]
+        if not all(all(names) for names in union):
+            raise BadSelectorException("Bad selector '%s'" % selector)
+        terms.append((excluded, union))
+    if not terms:
+        raise BadSelectorException("Bad selector '%s'" % selector)
+    return terms
+
+
+def _names_in(terms):
+    return [name
+            for (_, union) in terms
+            for names in union
+            for name in names]
+
+
+def _combine(terms, bits_of):
+    # Everything the terms include, less everything they exclude
+    included = 0
+    excluded = 0
+    for (is_excluded, union) in terms:
+        bits = 0
+        for names in union:
+            bits |= reduce(operator.and_, [bits_of(n) for n in names])
+        if is_excluded:
+            excluded |= bits
+        else:
+            included |= bits
+    return included & ~excluded
+
+
+def _reference_chain(entry):
+    chain = []
+    while entry:
+        (name, entry) = entry
+        chain.insert(0, name)
+    return chain
 
-    if selector in selector_stack:
-        stack_as_list = list(selector_stack) + [selector]
-        raise BadSelectorException(
+
+class SelectorGraph:
+    # The groups of a project and profile, compiled once. Each service gets
+    # a bit, so the services a selector resolves to are an int and set
+    # algebra is a few machine words at a time. Cycles are found up front;
+    # each selector is resolved at most once and then remembered, so groups
+    # shared by many others cost nothing the second time.
+
+    def __init__(self, project, service_sets):
+        self.project = project
+        self.service_names = sorted(project.services_by_name.keys())
+        self.service_bits = dict((name, 1 << i)
+                                 for (i, name) in enumerate(self.service_names))
+        # Later sets (the profile's) win over earlier ones with the same name
+        self.groups = dict((s.name, s) for s in service_sets)
+        self.group_terms = {}
+        self.resolved = {}
+        self.expressions = {}
+        self.cyclic = self._find_cyclic()
+
+    def _terms(self, name):
+        # Every selector in the group, as one big selector
+        if name not in self.group_terms:
+            self.group_terms[name] = sum(
+                [_parse_selector(s) for s in self.groups[name].selectors], [])
+        return self.group_terms[name]
+
+    def _group_members(self, name):
+        # The names used by the group that are themselves groups (services
+        # win over groups with the same name)
+        return [m for m in _names_in(self._terms(name))
+                if m in self.groups and m != "all" and
+                m not in self.service_bits]
+
+    def _find_cyclic(self):
+        # Groups that are part of a cycle or lead to one: whatever is left
+        # after repeatedly peeling off groups whose members are all done
+        waiting_on = {}
+        used_by = {}
+        for name in self.groups:
+            members = set(self._group_members(name))
+            waiting_on[name] = len(members)
+            for member in members:
+                used_by.setdefault(member, []).append(name)
+        ready = [name for (name, count) in waiting_on.items() if count == 0]
+        while ready:
+            name = ready.pop()
+            del waiting_on[name]
+            for user in used_by.get(name, []):
+                waiting_on[user] -= 1
+                if waiting_on[user] == 0:
+                    ready.append(user)
+        return frozenset(waiting_on)
+
+    def _circular(self, chain):
+        # Follows the cycle from the end of chain until it comes back around
+        chain = list(chain)
+        while chain.count(chain[-1]) == 1:
+            chain.append(sorted(m for m in self._group_members(chain[-1])
+                                if m in self.cyclic)[0])
+        return BadSelectorException(
             "Definition of selector '%s' is circular: %s" %
-            (stack_as_list[0], " -> ".join(stack_as_list)))
+            (chain[0], " -> ".join(chain)))
 
-    if selector == "all":
-        return frozenset(project.services_by_name.keys())
+    def names(self, bits):
+        # The names of the services whose bits are set, in order
+        names = []
+        while bits:
+            lowest = bits & -bits
+            names.append(self.service_names[lowest.bit_length() - 1])
+            bits ^= lowest
+        return names
 
-    if selector in project.services_by_name:
-        return frozenset([project.services_by_name[selector].name])
+    def resolve(self, selector):
+        return frozenset(self.names(self.resolve_bits(selector)))
+
+    def resolve_bits(self, selector):
+        assert selector
+        if selector not in self.expressions:
+            terms = _parse_selector(selector)
+            for name in _names_in(terms):
+                if name not in self.resolved:
+                    self._evaluate(name)
+            self.expressions[selector] = _combine(terms,
+                                                  self.resolved.__getitem__)
+        return self.expressions[selector]
+
+    def _evaluate(self, selector):
+        # Post-order walk (without recursion, so layers of groups can go as
+        # deep as they like): a group is resolved once all its members are.
+        # Stack entries are (selector, entry of the group that referenced it)
+        stack = [(selector, None)]
+        while stack:
+            entry = stack[-1]
+            name = entry[0]
+            if name in self.resolved:
+                stack.pop()
+            elif name == "all":
+                self.resolved[name] = (1 << len(self.service_names)) - 1
+            elif name in self.service_bits:
+                self.resolved[name] = self.service_bits[name]
+            elif name in self.cyclic:
+                raise self._circular(_reference_chain(entry))
+            elif name in self.groups:
+                terms = self._terms(name)
+                pending = [m for m in _names_in(terms)
+                           if m not in self.resolved]
+                if pending:
+                    # Reversed, so the first member is looked at first
+                    stack.extend((m, entry) for m in reversed(pending))
+                else:
+                    self.resolved[name] = _combine(terms,
+                                                   self.resolved.__getitem__)
+            else:
+                raise BadSelectorException(
+                    "No service or selector named '%s'. Reference chain: %s" %
+                    (name, " -> ".join(_reference_chain(entry))))
 
-    if selector in service_sets_by_name:
-        selector_stack[selector] = True
-        sub_results = map(lambda s: _resolve(s,
-                                             project,
-                                             service_sets_by_name,
-                                             selector_stack),
-                          service_sets_by_name[selector].selectors)
-        selector_stack.popitem(True)
-        return frozenset(reduce(frozenset.__or__, sub_results))
 
-    stack_as_list = list(selector_stack) + [selector]
-    raise BadSelectorException(
-        "No service or selector named '%s'. Reference chain: %s" %
-        (selector, " -> ".join(stack_as_list)))
+def _check_selector(selector, origin_file):
+    try:
+        _parse_selector(selector)
+    except BadSelectorException as e:
+        raise ParseProjectException("%s: %s" % (origin_file, e))
 
 
 class ServiceSet:
@@ -278,6 +1335,7 @@ class ServiceSet:
         selectors = []
         for selector in spec:
             _expect(str, selector, origin_file)
+            _check_selector(selector, origin_file)
             selectors.append(selector)
         return ServiceSet(name, selectors)
 
@@ -294,15 +1352,9 @@ class ServiceSet:
         if not spec:
             return None
         _expect(str, spec, origin_file)
+        _check_selector(spec, origin_file)
         return spec
 
-    @classmethod
-    def resolve(cls, selector, project, service_sets):
-        return _resolve(selector,
-                        project,
-                        dict((s.name, s) for s in service_sets),
-                        OrderedDict())
-
     @classmethod
     def as_printable_dict(cls, service_sets):
         return dict([(s.name, ', '.join(s.selectors)) for s in service_sets])
@@ -312,6 +1364,291 @@ class ServiceSet:
         self.selectors = selector_set
 
 
+##############################################
+# Discovery
+##############################################
+
+CACHE_DIR_NAME = ".ads_cache"
+IGNORE_FILE_NAME = ".adsignore"
+
+# Never worth descending into; .adsignore can add more (or "!name" to
+# un-prune one of these)
+DEFAULT_PRUNED_DIRS = [".git", ".hg", ".svn", ".idea", ".tox",
+                       "__pycache__", "node_modules", "bower_components",
+                       CACHE_DIR_NAME]
+
+WALK_THREADS = 8
+
+# Directories modified this recently might change again within the
+# filesystem's mtime granularity, so their listing is never trusted
+RACY_MTIME_WINDOW = 2
+
+
+class IgnoreRules:
+    @classmethod
+    def load(cls, project_root):
+        path = os.path.join(project_root, IGNORE_FILE_NAME)
+        patterns = list(DEFAULT_PRUNED_DIRS)
+        try:
+            st = os.stat(path)
+            with open(path, "r") as f:
+                lines = f.read().splitlines()
+        except (IOError, OSError):
+            return IgnoreRules(patterns, None)
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("!"):
+                if line[1:] in patterns:
+                    patterns.remove(line[1:])
+                continue
+            patterns.append(line.rstrip("/"))
+        return IgnoreRules(patterns, [st.st_mtime, st.st_size])
+
+    def __init__(self, patterns, signature=None):
+        # Patterns containing a slash match the path relative to the
+        # project root; others match a directory name anywhere
+        self.name_patterns = [p for p in patterns if "/" not in p]
+        self.path_patterns = [p.lstrip("/") for p in patterns if "/" in p]
+        self.signature = signature
+
+    def is_pruned(self, rel_dir, name):
+        for pattern in self.name_patterns:
+            if fnmatch.fnmatchcase(name, pattern):
+                return True
+        for pattern in self.path_patterns:
+            if fnmatch.fnmatchcase(rel_dir, pattern):
+                return True
+        return False
+
+
+def _subdir_names(abs_dir):
+    if _scandir:
+        return [e.name for e in _scandir(abs_dir)
+                if e.is_dir(follow_symlinks=False)]
+    return [n for n in os.listdir(abs_dir)
+            if stat.S_ISDIR(os.lstat(os.path.join(abs_dir, n)).st_mode)]
+
+
+def _list_dir(abs_dir, rel_dir, ignore_rules, scan_time):
+    mtime = os.stat(abs_dir).st_mtime
+    if scan_time - mtime < RACY_MTIME_WINDOW:
+        mtime = -1
+    has_yml = os.path.isfile(os.path.join(abs_dir, "ads.yml"))
+    has_root = os.path.isfile(os.path.join(abs_dir, "adsroot.yml"))
+    if has_root and rel_dir != ".":
+        # Nested project; nothing below here belongs to us
+        return [mtime, has_yml, has_root, []]
+    subdirs = sorted([
+        n for n in _subdir_names(abs_dir)
+        if not ignore_rules.is_pruned(
+            os.path.normpath(os.path.join(rel_dir, n)), n)])
+    return [mtime, has_yml, has_root, subdirs]
+
+
+def _parallel_walk(roots, expand, threads=WALK_THREADS):
+    # Calls expand(node) for every node reachable from roots, where expand
+    # returns the node's children. Siblings are expanded concurrently.
+    pending = list(roots)
+    in_flight = [0]
+    failures = []
+    cond = threading.Condition()
+
+    def work():
+        while True:
+            with cond:
+                while not pending and in_flight[0] > 0:
+                    cond.wait()
+                if not pending:
+                    return
+                node = pending.pop()
+                in_flight[0] += 1
+            try:
+                children = expand(node)
+            except Exception as e:
+                failures.append(e)
+                children = []
+            with cond:
+                pending.extend(children)
+                in_flight[0] -= 1
+                cond.notify_all()
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    for w in workers:
+        w.daemon = True
+        w.start()
+    for w in workers:
+        w.join()
+    if failures:
+        raise failures[0]
+
+
+##############################################
+# Manifest
+##############################################
+
+MANIFEST_VERSION = 3
+
+# Parsing is quick with libyaml; only start processes for lots of specs
+SPEC_PREFETCH_MIN_FILES = 64
+
+
+def _parse_spec_job(path):
+    # Runs in a worker process. Failures are left for the main process to
+    # hit again and report.
+    try:
+        return (path, _load_spec_file(path))
+    except Exception:
+        return (path, None)
+
+
+class Manifest:
+    # Persistent record of a project's directory tree (mtime, whether it
+    # holds ads.yml/adsroot.yml, subdirs) and of its parsed spec files.
+    # Only directories whose mtime changed since the last run are re-listed,
+    # and only spec files whose mtime, size or inode changed are re-parsed.
+    # Specs are only saved once the services using them have loaded, so the
+    # cached specs are ones that passed validation.
+
+    @classmethod
+    def load(cls, project_root, rescan=False):
+        manifest = Manifest(project_root)
+        if rescan:
+            manifest.dirty = True
+            return manifest
+        try:
+            with open(manifest.path, "rb") as f:
+                contents = marshal.load(f)
+            if contents.get("version") == MANIFEST_VERSION:
+                manifest.specs = contents["specs"]
+                if contents["ignore"] == manifest.ignore_rules.signature:
+                    manifest.dirs = contents["dirs"]
+                else:
+                    manifest.dirty = True
+        except (IOError, OSError, EOFError, ValueError, TypeError,
+                AttributeError, KeyError):
+            # Missing or corrupt; start from scratch
+            manifest.dirty = True
+        return manifest
+
+    def __init__(self, project_root):
+        self.project_root = project_root
+        self.path = os.path.join(project_root, CACHE_DIR_NAME, "manifest")
+        self.ignore_rules = IgnoreRules.load(project_root)
+        self.dirs = {}
+        self.specs = {}
+        self.prefetched = {}
+        self.service_ymls = []
+        self.dirty = False
+
+    def refresh(self):
+        scan_time = time.time()
+        new_dirs = {}
+
+        def expand(rel_dir):
+            abs_dir = os.path.join(self.project_root, rel_dir)
+            old = self.dirs.get(rel_dir)
+            try:
+                if (old and old[0] != -1 and
+                        os.stat(abs_dir).st_mtime == old[0]):
+                    entry = old
+                else:
+                    entry = _list_dir(abs_dir, rel_dir,
+                                      self.ignore_rules, scan_time)
+                    self.dirty = True
+            except OSError:
+                # Vanished while we were looking
+                self.dirty = True
+                return []
+            new_dirs[rel_dir] = entry
+            return [os.path.normpath(os.path.join(rel_dir, d))
+                    for d in entry[3]]
+
+        _parallel_walk(["."], expand)
+        if len(new_dirs) != len(self.dirs):
+            self.dirty = True
+        self.dirs = new_dirs
+        return [
+            os.path.join(self.project_root, rel_dir, "ads.yml")
+            for (rel_dir, entry) in sorted(self.dirs.items())
+            if rel_dir != "." and entry[1] and not entry[2]
+        ]
+
+    def _cached_spec(self, path):
+        # (cache key, stat signature, cached spec or None)
+        key = os.path.relpath(path, self.project_root)
+        st = os.stat(path)
+        signature = [st.st_mtime, st.st_size, st.st_ino]
+        cached = self.specs.get(key)
+        if cached and cached[:3] == signature:
+            return (key, signature, cached[3])
+        return (key, signature, None)
+
+    def prefetch(self, paths):
+        # Parses the specs that aren't cached, in parallel when there are
+        # enough of them to be worth it
+        import multiprocessing
+        misses = [p for p in paths if self._cached_spec(p)[2] is None]
+        cpus = multiprocessing.cpu_count()
+        if len(misses) < SPEC_PREFETCH_MIN_FILES or cpus < 2:
+            return
+        pool = multiprocessing.Pool(min(len(misses), cpus))
+        chunk_size = max(1, len(misses) // cpus)
+        try:
+            for (path, spec) in pool.imap_unordered(_parse_spec_job, misses,
+                                                    chunk_size):
+                if spec is not None:
+                    self.prefetched[path] = spec
+        finally:
+            pool.terminate()
+
+    def load_spec_file(self, path):
+        (key, signature, cached) = self._cached_spec(path)
+        if cached is not None:
+            return cached
+        spec = self.prefetched.pop(path, None)
+        if spec is None:
+            spec = _load_spec_file(path)
+        self.specs.pop(key, None)
+        self.dirty = True
+        if time.time() - signature[0] < RACY_MTIME_WINDOW:
+            return spec
+        try:
+            marshal.dumps(spec)
+            self.specs[key] = signature + [spec]
+        except ValueError:
+            # Unusual YAML types (e.g. dates) can't be cached; just reparse
+            pass
+        return spec
+
+    def save(self, service_ymls=None):
+        if service_ymls is not None:
+            self.service_ymls = service_ymls
+        if not self.dirty:
+            return
+        live_specs = set(["adsroot.yml"] + [
+            os.path.relpath(p, self.project_root)
+            for p in self.service_ymls])
+        for key in list(self.specs.keys()):
+            if key not in live_specs:
+                del self.specs[key]
+        tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.mkdir(os.path.dirname(self.path))
+            with open(tmp_path, "wb") as f:
+                marshal.dump({"version": MANIFEST_VERSION,
+                              "ignore": self.ignore_rules.signature,
+                              "dirs": self.dirs,
+                              "specs": self.specs}, f)
+            os.rename(tmp_path, self.path)
+            self.dirty = False
+        except (IOError, OSError):
+            # Read-only checkout or similar; we'll just scan next time too
+            pass
+
+
 ##############################################
 # Project
 ##############################################
@@ -327,31 +1664,97 @@ def _find_project_yml(search_start):
         return _find_project_yml(parent)
 
 
-def _find_service_ymls(project_root):
-    find_output = _shell_get_output(
-        "/usr/bin/find . -mindepth 2 -name ads.yml -or -name adsroot.yml",
-        project_root).splitlines()
+DISCOVERY_STRATEGIES = ["auto", "git", "walk"]
 
-    nested_project_dirs = [
-        os.path.dirname(path)
-        for path in find_output
-        if os.path.basename(path) == "adsroot.yml"
-    ]
 
-    def in_nested_project_dir(path_str):
-        for dir_path in nested_project_dirs:
-            if path_str.startswith(dir_path):
+def _find_git_work_tree(search_start):
+    if os.path.exists(os.path.join(search_start, ".git")):
+        return search_start
+    parent = os.path.dirname(search_start)
+    if parent == search_start:
+        return None
+    else:
+        return _find_git_work_tree(parent)
+
+
+def _has_submodules_in(work_tree, project_root):
+    try:
+        with open(os.path.join(work_tree, ".gitmodules")) as f:
+            gitmodules = f.read()
+    except IOError:
+        return False
+    for rel_path in re.findall(r"(?m)^\s*path\s*=\s*(.+?)\s*$", gitmodules):
+        path = os.path.normpath(os.path.join(work_tree, rel_path))
+        if (path + os.sep).startswith(project_root.rstrip(os.sep) + os.sep):
+            return True
+    return False
+
+
+def _git_service_ymls(project_root, ignore_rules):
+    # Asks git's index (plus untracked files it isn't ignoring) instead of
+    # walking the tree. Returns None if git can't help: git doesn't know
+    # about the project at all (it's in an ignored directory, say), or
+    # there are other repositories inside it, whose files git won't list.
+    import subprocess
+    work_tree = _find_git_work_tree(project_root)
+    if work_tree and _has_submodules_in(work_tree, project_root):
+        return None
+    try:
+        process = subprocess.Popen(
+            # (With "*/", untracked repositories show up as "dir/")
+            ["git", "ls-files", "-z", "--cached", "--others",
+             "--exclude-standard", "--", "*ads.yml", "*adsroot.yml", "*/"],
+            stdout=subprocess.PIPE,
+            stderr=open(os.devnull, "w"),
+            close_fds=True,
+            cwd=project_root)
+    except OSError:
+        return None
+    output = process.communicate()[0]
+    if process.returncode != 0:
+        return None
+    rel_paths = set(output.split("\0"))
+    if "adsroot.yml" not in rel_paths or \
+            [p for p in rel_paths if p.endswith("/")]:
+        return None
+
+    ymls_by_dir = {}
+    for rel_path in rel_paths:
+        basename = os.path.basename(rel_path)
+        if basename not in ("ads.yml", "adsroot.yml"):
+            continue
+        rel_dir = os.path.dirname(rel_path) or "."
+        ymls_by_dir.setdefault(rel_dir, set()).add(basename)
+
+    def excluded(rel_dir):
+        # Below a nested project or a pruned dir?
+        while rel_dir not in (".", ""):
+            if "adsroot.yml" in ymls_by_dir.get(rel_dir, ()):
                 return True
+            if ignore_rules.is_pruned(rel_dir, os.path.basename(rel_dir)):
+                return True
+            rel_dir = os.path.dirname(rel_dir)
         return False
 
-    # BEWARE: O(n*m) algorithm!
     return [
-        os.path.join(project_root, p)
-        for p in find_output
-        if os.path.basename(p) == "ads.yml" and not in_nested_project_dir(p)
+        os.path.join(project_root, rel_dir, "ads.yml")
+        for (rel_dir, basenames) in sorted(ymls_by_dir.items())
+        if rel_dir != "." and "ads.yml" in basenames and
+        not excluded(rel_dir) and
+        # Deleted from the work tree but still in the index
+        os.path.isfile(os.path.join(project_root, rel_dir, "ads.yml"))
     ]
 
 
+def _find_service_ymls(project_root, manifest, strategy="auto"):
+    if strategy == "git" or (
+            strategy == "auto" and _find_git_work_tree(project_root)):
+        ymls = _git_service_ymls(project_root, manifest.ignore_rules)
+        if ymls is not None:
+            return ymls
+    return manifest.refresh()
+
+
 def _adsfiles_to_service_names(adsfiles):
     svc_name_to_file = {}
     file_to_svc_name = {}
@@ -366,21 +1769,41 @@ def _adsfiles_to_service_names(adsfiles):
 
 class Project:
     @classmethod
-    def load_from_dir(cls, root_dir):
+    def load_from_dir(cls, root_dir, rescan=False):
         project_yml = _find_project_yml(os.path.abspath(root_dir))
         if not project_yml:
             return None
 
-        service_ymls = _find_service_ymls(os.path.dirname(project_yml))
-        return Project.load_from_files(project_yml, service_ymls)
+        manifest = Manifest.load(os.path.dirname(project_yml), rescan)
+        service_ymls = _find_service_ymls(
+            os.path.dirname(project_yml),
+            manifest,
+            Project.load_discovery_strategy(
+                manifest.load_spec_file(project_yml), project_yml))
+        project = Project.load_from_files(project_yml, service_ymls,
+                                          manifest.load_spec_file)
+        project.manifest = manifest
+        manifest.save(service_ymls)
+        return project
+
+    @classmethod
+    def load_discovery_strategy(cls, spec, origin_file):
+        strategy = spec.get("discovery") or "auto"
+        _expect(str, strategy, origin_file)
+        if strategy not in DISCOVERY_STRATEGIES:
+            raise ParseProjectException(
+                "%s: discovery must be one of %s, got %s" %
+                (origin_file, ", ".join(DISCOVERY_STRATEGIES), strategy))
+        return strategy
 
     @classmethod
-    def load_from_files(cls, project_yml, svc_ymls):
-        spec = _load_spec_file(project_yml)
+    def load_from_files(cls, project_yml, svc_ymls,
+                        load_spec=_load_spec_file):
+        spec = load_spec(project_yml)
         home = os.path.dirname(project_yml)
         name = spec.get("name") or os.path.basename(home)
         services = [
-            Service.load(svc_file, svc_name)
+            LazyService(svc_file, svc_name, load_spec)
             for (svc_file, svc_name)
             in _adsfiles_to_service_names(svc_ymls).items()
         ]
@@ -388,17 +1811,35 @@ class Project:
             spec.get("groups"), project_yml)
         default_selector = ServiceSet.load_default(
             spec.get("default"), project_yml) or "all"
-        return Project(name, home, services, service_sets, default_selector)
+        return Project(name, home, services, service_sets, default_selector,
+                       _load_jobs(spec, project_yml),
+                       _load_shell_engine(spec, project_yml))
 
     def __init__(self,
                  name, home,
                  services=None, service_sets=None,
-                 default_selector="all"):
+                 default_selector="all", jobs=None, shell_engine=None):
         self.name = name
         self.home = home
         self.services_by_name = dict((s.name, s) for s in (services or []))
         self.service_sets = service_sets or []
         self.default_selector = default_selector
+        self.jobs = jobs
+        self.shell_engine = shell_engine
+        self.manifest = None
+
+    def load_services(self, services):
+        # Parses the specs of the services that are still lazy, in bulk
+        lazy = [s for s in services
+                if isinstance(s, LazyService) and not s.service]
+        if not lazy:
+            return
+        if self.manifest:
+            self.manifest.prefetch([s.svc_yml for s in lazy])
+        for s in lazy:
+            s.load()
+        if self.manifest:
+            self.manifest.save()
 
 
 ##############################################
@@ -415,11 +1856,16 @@ class Profile:
         rc_spec = _load_spec_file(rc_path)
         return Profile(
             ServiceSet.load_multiple(rc_spec.get("groups"), rc_path),
-            ServiceSet.load_default(rc_spec.get("default"), rc_path))
+            ServiceSet.load_default(rc_spec.get("default"), rc_path),
+            _load_jobs(rc_spec, rc_path),
+            _load_shell_engine(rc_spec, rc_path))
 
-    def __init__(self, service_sets=None, default_selector=None):
+    def __init__(self, service_sets=None, default_selector=None, jobs=None,
+                 shell_engine=None):
         self.service_sets = service_sets or []
         self.default_selector = default_selector
+        self.jobs = jobs
+        self.shell_engine = shell_engine
 
 
 ##############################################
@@ -428,8 +1874,8 @@ class Profile:
 
 class Ads:
     @staticmethod
-    def load_from_fs(root_dir, profile_dir):
-        project = Project.load_from_dir(root_dir)
+    def load_from_fs(root_dir, profile_dir, rescan=False):
+        project = Project.load_from_dir(root_dir, rescan)
         if not project:
             return None
 
@@ -437,31 +1883,43 @@ class Ads:
         return Ads(project, profile)
 
     @staticmethod
-    def load_from_env():
+    def load_from_env(rescan=False):
         profile_home = os.getenv("ADS_PROFILE_HOME")
         if not profile_home or len(profile_home) == 0:
             profile_home = os.path.expanduser("~")
-        return Ads.load_from_fs(os.curdir, profile_home)
+        return Ads.load_from_fs(os.curdir, profile_home, rescan)
 
     def __init__(self, project, profile=Profile()):
         self.project = project
         self.profile = profile
+        self.selector_graph = None
 
     def resolve(self, selector):
 
-        if selector == "default":
-            selector = self.get_default_selector()
+        selector = " ".join([
+            term == "default" and self.get_default_selector() or term
+            for term in selector.split()])
 
-        return ServiceSet.resolve(
-            selector,
-            self.project,
-            self.project.service_sets + self.profile.service_sets)
+        if not self.selector_graph:
+            self.selector_graph = SelectorGraph(
+                self.project,
+                self.project.service_sets + self.profile.service_sets)
+        return self.selector_graph.resolve(selector)
 
     def get_default_selector(self):
         return (self.profile.default_selector or
                 self.project.default_selector)
 
+    def get_jobs(self, requested=None):
+        return requested or self.profile.jobs or self.project.jobs or 1
+
+    def get_shell_engine(self):
+        return (self.profile.shell_engine or
+                self.project.shell_engine or
+                "process")
+
     def list(self):
+        self.project.load_services(self.project.services_by_name.values())
         default_selector = self.get_default_selector()
         try:
             default_description = ', '.join(self.resolve(default_selector))
@@ -490,11 +1948,1136 @@ class Ads:
         ).pretty_print()
 
 
+##############################################
+# Log following
+##############################################
+
+# Used when a service doesn't set log_timestamp_format
+DEFAULT_TIMESTAMP_FORMATS = ["%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S"]
+# Any time will do, as long as every field is at its full width
+# (2000-11-22 11:22:33, a Wednesday)
+_TIMESTAMP_SAMPLE = (2000, 11, 22, 11, 22, 33, 2, 327, -1)
+_FRACTION_RE = re.compile(r"[.,](\d+)")
+
+
+class TimestampParser:
+    # Reads the timestamp at the start of a log line. Formats are strptime
+    # formats and must be fixed-width; fractional seconds after them are
+    # understood too.
+
+    def __init__(self, formats=None):
+        self.formats = [(fmt, len(time.strftime(fmt, _TIMESTAMP_SAMPLE)))
+                        for fmt in formats or DEFAULT_TIMESTAMP_FORMATS]
+        # Busy logs repeat the same second a lot, and strptime is slow
+        self.last_parsed = (None, None)
+
+    def _strptime(self, text, fmt):
+        if self.last_parsed[0] != (text, fmt):
+            import datetime
+            self.last_parsed = ((text, fmt),
+                                datetime.datetime.strptime(text, fmt))
+        return self.last_parsed[1]
+
+    def parse(self, line):
+        for (fmt, width) in self.formats:
+            try:
+                stamp = self._strptime(line[:width], fmt)
+            except ValueError:
+                continue
+            fraction = _FRACTION_RE.match(line, width)
+            if fraction:
+                stamp = stamp.replace(
+                    microsecond=int(fraction.group(1)[:6].ljust(6, "0")))
+            return stamp
+        return None
+
+
+class _StampedLines:
+    # Lines without a timestamp of their own (stack traces, say) belong to
+    # the last line that had one
+    def __init__(self, parser):
+        import datetime
+        self.parser = parser
+        self.last = datetime.datetime.min
+
+    def stamp(self, line):
+        self.last = self.parser.parse(line) or self.last
+        return self.last
+
+
+class _FollowedFile:
+    def __init__(self, inode, offset, head="", mtime=None):
+        self.inode = inode
+        self.offset = offset
+        self.head = head
+        self.mtime = mtime
+        self.partial = ""
+
+
+# How much of a file to read at a time when working backwards from the end
+LAST_LINES_BLOCK_SIZE = 64 * 1024
+# Compared to notice a followed log that was truncated and then rewritten
+# past where we'd read up to
+FOLLOW_FINGERPRINT_SIZE = 256
+
+
+def _read_at(fd, offset, count):
+    os.lseek(fd, offset, os.SEEK_SET)
+    chunks = []
+    while count > 0:
+        data = os.read(fd, count)
+        if not data:
+            break
+        chunks.append(data)
+        count -= len(data)
+    return "".join(chunks)
+
+
+def _last_lines_offset(fd, size, lines):
+    # Where the last `lines` lines of the file start. Reads backwards from
+    # the end a block at a time, so a huge file costs no more than a small
+    # one.
+    if lines <= 0:
+        return size
+    pos = size
+    # A newline at the very end terminates the last line; it doesn't start
+    # a new one
+    if size > 0 and _read_at(fd, size - 1, 1) == "\n":
+        pos = size - 1
+    while pos > 0:
+        block_start = max(0, pos - LAST_LINES_BLOCK_SIZE)
+        block = _read_at(fd, block_start, pos - block_start)
+        count = block.count("\n")
+        if count < lines:
+            # The start is further back yet
+            lines -= count
+            pos = block_start
+            continue
+        found = len(block)
+        for _ in range(lines):
+            found = block.rfind("\n", 0, found)
+        return block_start + found + 1
+    return 0
+
+
+class LogFollower:
+    # Follows a changing set of log files, like tail -F: they needn't exist
+    # yet, they may be truncated or replaced (say, when the service
+    # restarts, or the log is rotated, in which case the rest of the old
+    # file is read first), and list_paths may return new ones over time.
+    # Files are only open while being read, so any number can be followed.
+
+    # Lines longer than this are split rather than buffered forever
+    MAX_PARTIAL = 64 * 1024
+
+    def __init__(self, list_paths, from_end=True, backlog_lines=0):
+        self.list_paths = list_paths
+        self.files = {}
+        if from_end:
+            for path in list_paths():
+                try:
+                    fd = os.open(path, os.O_RDONLY)
+                except OSError:
+                    continue
+                try:
+                    st = os.fstat(fd)
+                    offset = _last_lines_offset(fd, st.st_size, backlog_lines)
+                    head = _read_at(fd, 0, FOLLOW_FINGERPRINT_SIZE)
+                finally:
+                    os.close(fd)
+                self.files[path] = _FollowedFile(st.st_ino, offset, head,
+                                                 st.st_mtime)
+
+    def read_lines(self):
+        # Returns [(path, [line, ...])] for the complete lines written
+        # since the last call
+        result = []
+        for path in self.list_paths():
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            followed = self.files.get(path)
+            lines = []
+            if followed is not None and followed.inode != st.st_ino:
+                # Replaced, probably by rotation: finish reading the old
+                # file first
+                lines = self._finish_rotated(path, followed)
+                followed = None
+            if followed is None:
+                # New (or replaced): read it from the start
+                followed = _FollowedFile(st.st_ino, 0)
+                self.files[path] = followed
+            if (st.st_size != followed.offset or
+                    st.st_mtime != followed.mtime):
+                lines += self._read_more(path, st, followed)
+            if lines:
+                result.append((path, lines))
+        return result
+
+    def _read_more(self, path, st, followed):
+        try:
+            with open(path, "rb") as f:
+                head = f.read(FOLLOW_FINGERPRINT_SIZE)
+                if (st.st_size < followed.offset or
+                        not head.startswith(followed.head)):
+                    # Truncated, and maybe rewritten past our offset since
+                    # we last looked: start over
+                    followed.offset = 0
+                    followed.partial = ""
+                f.seek(followed.offset)
+                data = f.read(max(0, st.st_size - followed.offset))
+        except IOError:
+            return []
+        followed.head = head
+        followed.mtime = st.st_mtime
+        followed.offset += len(data)
+        lines = (followed.partial + data).split("\n")
+        followed.partial = lines.pop()
+        if len(followed.partial) > LogFollower.MAX_PARTIAL:
+            lines.append(followed.partial)
+            followed.partial = ""
+        return lines
+
+    def _finish_rotated(self, path, followed):
+        # What was written to the file we were following after we last
+        # read it, if it's still around under a rotated name
+        for rotated in reversed(_with_rotated([path])[:-1]):
+            try:
+                with open(rotated, "rb") as f:
+                    if os.fstat(f.fileno()).st_ino != followed.inode:
+                        continue
+                    f.seek(followed.offset)
+                    data = f.read()
+            except IOError:
+                continue
+            lines = (followed.partial + data).split("\n")
+            if not lines[-1]:
+                lines.pop()
+            return lines
+        return []
+
+
+# inotify(7) event masks
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_MOVE_SELF = 0x800
+IN_WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_MOVED_TO | IN_CREATE |
+                 IN_DELETE | IN_MOVE_SELF)
+
+
+def _inotify_init():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | 0o2000000)  # O_CLOEXEC
+    except (ImportError, OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    return (libc, fd)
+
+
+class DirWatcher:
+    # Wakes up a log follower when something changes in the directories
+    # its logs are in. Uses inotify where there is one; otherwise (or if we
+    # run out of inotify watches) wait() just sleeps and the follower polls.
+
+    def __init__(self):
+        self.inotify = _inotify_init()
+        self.watched = set()
+        self.complete = self.inotify is not None
+
+    def watch(self, dirs):
+        if not self.inotify:
+            return
+        (libc, fd) = self.inotify
+        for d in dirs:
+            if d in self.watched:
+                continue
+            if libc.inotify_add_watch(fd, d, IN_WATCH_MASK) < 0:
+                # Gone already, or out of watches: fall back to polling
+                self.complete = False
+            self.watched.add(d)
+
+    def wait(self, timeout):
+        if not self.complete:
+            timeout = min(timeout, LOG_POLL_INTERVAL)
+        if not self.inotify:
+            time.sleep(timeout)
+            return
+        fd = self.inotify[1]
+        if select.select([fd], [], [], timeout)[0]:
+            # Events just mean "look again"; we don't need the details
+            try:
+                while os.read(fd, 65536):
+                    pass
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def close(self):
+        if self.inotify:
+            os.close(self.inotify[1])
+
+
+def _watch_dirs(log_globs):
+    # The directories whose changes could affect what these (absolute) globs
+    # match: the deepest existing ancestor that has no wildcards, and the
+    # directory of every file matched right now
+    import glob
+    dirs = set()
+    for log_glob in log_globs:
+        static = []
+        for part in log_glob.split(os.sep)[:-1]:
+            if glob.has_magic(part):
+                break
+            static.append(part)
+        static_dir = os.sep.join(static) or os.sep
+        while not os.path.isdir(static_dir):
+            static_dir = os.path.dirname(static_dir)
+        dirs.add(static_dir)
+        for path in glob.iglob(log_glob):
+            dirs.add(os.path.dirname(path))
+    return dirs
+
+
+##############################################
+# Rotated and compressed logs
+##############################################
+
+COMPRESSED_EXTENSIONS = [".gz", ".bz2", ".zst"]
+# foo.log.1, foo.log.2.gz (logrotate's default) or foo.log-20150601.bz2
+# (its dateext option)
+ROTATED_SUFFIX_RE = re.compile(r"^([.-])(\d+)(\.gz|\.bz2|\.zst)?$")
+# How many files to decompress ahead of the one being read
+DECOMPRESS_THREADS = 4
+DECOMPRESS_CHUNK_SIZE = 256 * 1024
+# Chunks decompressed ahead of the reader, per file
+DECOMPRESS_QUEUE_CHUNKS = 4
+
+
+def _is_compressed(path):
+    return os.path.splitext(path)[1] in COMPRESSED_EXTENSIONS
+
+
+def _open_zstd(path):
+    import subprocess
+    try:
+        import zstandard
+    except ImportError:
+        zstandard = None
+    if zstandard:
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+    # No python bindings; the command line tool will do
+    try:
+        return subprocess.Popen(["zstd", "-dcq", path],
+                                stdout=subprocess.PIPE,
+                                stderr=open(os.devnull, "w")).stdout
+    except OSError:
+        raise IOError("reading %s needs the zstandard python package or "
+                      "the zstd command" % path)
+
+
+def _open_decompressed(path):
+    ext = os.path.splitext(path)[1]
+    if ext == ".gz":
+        import gzip
+        return gzip.open(path, "rb")
+    elif ext == ".bz2":
+        import bz2
+        return bz2.BZ2File(path, "rb")
+    elif ext == ".zst":
+        return _open_zstd(path)
+    return open(path, "rb")
+
+
+class _Inflater(threading.Thread):
+    # Decompresses one file into a short queue of chunks. zlib and bz2 let
+    # go of the GIL while they work, so several of these really do overlap.
+
+    def __init__(self, path):
+        import Queue
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.queue = Queue.Queue(DECOMPRESS_QUEUE_CHUNKS)
+
+    def run(self):
+        import zlib
+        try:
+            stream = _open_decompressed(self.path)
+            try:
+                while True:
+                    data = stream.read(DECOMPRESS_CHUNK_SIZE)
+                    if not data:
+                        break
+                    self.queue.put(data)
+            finally:
+                stream.close()
+            self.queue.put(None)
+        except (IOError, OSError, EOFError, ValueError, zlib.error) as e:
+            self.queue.put(IOError(str(e)))
+
+    def chunks(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if isinstance(item, IOError):
+                raise item
+            yield item
+
+
+class Inflaters:
+    # Hands out the decompressed contents of compressed files, decompressing
+    # the next few of them (in order) in the background meanwhile
+
+    def __init__(self, paths, ahead=DECOMPRESS_THREADS):
+        self.paths = [p for p in paths if _is_compressed(p)]
+        self.ahead = ahead
+        self.started = {}
+
+    def chunks(self, path):
+        position = self.paths.index(path)
+        for upcoming in self.paths[position:position + self.ahead]:
+            if upcoming not in self.started:
+                self.started[upcoming] = _Inflater(upcoming)
+                self.started[upcoming].start()
+        return self.started.pop(path).chunks()
+
+
+def _iter_lines(chunks):
+    # Lines (with their newlines) from a sequence of chunks
+    partial = ""
+    for chunk in chunks:
+        lines = (partial + chunk).split("\n")
+        partial = lines.pop()
+        for line in lines:
+            yield line + "\n"
+    if partial:
+        yield partial
+
+
+def _rotated_order(match):
+    (style, number, _) = match.groups()
+    if style == ".":
+        # foo.log.1 is newer than foo.log.2
+        return (0, -int(number))
+    # Dates (or whatever) count up
+    return (1, int(number))
+
+
+def _with_rotated(paths):
+    # Each log preceded by its rotated (and maybe compressed) predecessors,
+    # oldest first. Rotated files that were matched directly are moved to
+    # their place in the sequence.
+    listings = {}
+    siblings = {}
+    for path in paths:
+        (dir_name, base) = os.path.split(path)
+        if dir_name not in listings:
+            try:
+                listings[dir_name] = os.listdir(dir_name or os.curdir)
+            except OSError:
+                listings[dir_name] = []
+        found = []
+        for name in listings[dir_name]:
+            if name.startswith(base):
+                match = ROTATED_SUFFIX_RE.match(name[len(base):])
+                if match:
+                    found.append((_rotated_order(match),
+                                  os.path.join(dir_name, name)))
+        siblings[path] = [p for (_, p) in sorted(found)]
+    claimed = set(sum(siblings.values(), []))
+    result = []
+    for path in paths:
+        if path not in claimed:
+            result += siblings[path] + [path]
+    return result
+
+
+##############################################
+# Log index
+##############################################
+
+LOG_INDEX_VERSION = 1
+# An index entry every this many lines; a lookup reads at most this many
+LOG_INDEX_EVERY = 1000
+# Compared to notice a log that was truncated and then grew back
+LOG_INDEX_FINGERPRINT_SIZE = 256
+
+
+def _stamp_key(stamp):
+    # Something marshal can store that sorts the same as the datetime
+    return (stamp.year, stamp.month, stamp.day,
+            stamp.hour, stamp.minute, stamp.second, stamp.microsecond)
+
+
+class LogIndex:
+    # A sparse, persistent map from timestamps to byte offsets in one log
+    # file, so finding a time window means reading a few lines rather than
+    # the whole file. Built lazily, extended as the log grows, and thrown
+    # away if it's rotated or truncated. Lines are assumed to be in time
+    # order.
+
+    @classmethod
+    def open(cls, cache_dir, path, formats):
+        import hashlib
+        abs_path = os.path.abspath(path)
+        index = LogIndex(abs_path, formats, os.path.join(
+            cache_dir, hashlib.sha1(abs_path).hexdigest()))
+        index.load()
+        index.update()
+        return index
+
+    def __init__(self, path, formats, index_path):
+        self.path = path
+        self.formats = formats or DEFAULT_TIMESTAMP_FORMATS
+        self.parser = TimestampParser(self.formats)
+        self.index_path = index_path
+        self.reset()
+
+    def reset(self):
+        self.inode = None
+        self.fingerprint = ""
+        # Everything before this offset (always a line start) is indexed
+        self.size = 0
+        # [stamp key, offset of a line with that timestamp]
+        self.entries = []
+        self.lines_since_entry = 0
+        self.dirty = True
+
+    def load(self):
+        try:
+            with open(self.index_path, "rb") as f:
+                data = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            return
+        if (not isinstance(data, dict) or
+                data.get("version") != LOG_INDEX_VERSION or
+                data.get("formats") != self.formats):
+            return
+        self.inode = data["inode"]
+        self.fingerprint = data["fingerprint"]
+        self.size = data["size"]
+        self.entries = data["entries"]
+        self.lines_since_entry = data["lines_since_entry"]
+        self.dirty = False
+
+    def save(self):
+        if not self.dirty:
+            return
+        tmp_path = "%s.%d.tmp" % (self.index_path, os.getpid())
+        try:
+            if not os.path.isdir(os.path.dirname(self.index_path)):
+                os.makedirs(os.path.dirname(self.index_path))
+            with open(tmp_path, "wb") as f:
+                marshal.dump({"version": LOG_INDEX_VERSION,
+                              "formats": self.formats,
+                              "inode": self.inode,
+                              "fingerprint": self.fingerprint,
+                              "size": self.size,
+                              "entries": self.entries,
+                              "lines_since_entry": self.lines_since_entry}, f)
+            os.rename(tmp_path, self.index_path)
+            self.dirty = False
+        except (IOError, OSError):
+            # Can't write the cache; we'll just index again next time
+            pass
+
+    def update(self):
+        with open(self.path, "rb") as f:
+            st = os.fstat(f.fileno())
+            head = f.read(LOG_INDEX_FINGERPRINT_SIZE)
+            if (st.st_ino != self.inode or st.st_size < self.size or
+                    not head.startswith(self.fingerprint)):
+                # Rotated or truncated (maybe then grown back)
+                self.reset()
+            if head != self.fingerprint:
+                self.fingerprint = head
+                self.inode = st.st_ino
+                self.dirty = True
+            if st.st_size == self.size:
+                return
+            f.seek(self.size)
+            offset = self.size
+            for line in f:
+                if not line.endswith("\n"):
+                    # Still being written
+                    break
+                # Only parse (slow) when it's time for another entry
+                if not self.entries or \
+                        self.lines_since_entry >= LOG_INDEX_EVERY:
+                    stamp = self.parser.parse(line)
+                    if stamp:
+                        self.entries.append([_stamp_key(stamp), offset])
+                        self.lines_since_entry = 0
+                self.lines_since_entry += 1
+                offset += len(line)
+            self.size = offset
+            self.dirty = True
+        self.save()
+
+    def _first_offset(self, start_entry, matches):
+        # Offset of the first line from entries[start_entry] on whose
+        # timestamp (or inherited timestamp) matches, else the end of file
+        if start_entry < 0:
+            (last, offset) = (None, 0)
+        else:
+            (last, offset) = self.entries[start_entry]
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                stamp = self.parser.parse(line)
+                if stamp:
+                    last = _stamp_key(stamp)
+                if last is not None and matches(last):
+                    return offset
+                offset += len(line)
+        return offset
+
+    def find(self, since=None, until=None):
+        # (start, end) byte offsets of the lines from since up to and
+        # including until
+        import bisect
+        stamps = [stamp for (stamp, _) in self.entries]
+        start = 0
+        if since:
+            since = _stamp_key(since)
+            start = self._first_offset(bisect.bisect_left(stamps, since) - 1,
+                                       lambda stamp: stamp >= since)
+        if until:
+            until = _stamp_key(until)
+            end = self._first_offset(bisect.bisect_right(stamps, until) - 1,
+                                     lambda stamp: stamp > until)
+        else:
+            end = os.path.getsize(self.path)
+        return (start, max(start, end))
+
+
+##############################################
+# Log dumping
+##############################################
+
+# For copying when we can't sendfile
+CAT_BUFFER_SIZE = 1024 * 1024
+# Most sendfile implementations cap a single call around here anyway
+SENDFILE_CHUNK = 1 << 30
+
+
+def _find_sendfile():
+    # os.sendfile(out_fd, in_fd, offset, count) if python has it (3.3+),
+    # otherwise the same thing from libc on Linux, where the destination can
+    # be any file or pipe
+    if hasattr(os, "sendfile"):
+        return os.sendfile
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc_sendfile = getattr(libc, "sendfile64", None) or libc.sendfile
+    except (ImportError, OSError, AttributeError):
+        return None
+    libc_sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                              ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    libc_sendfile.restype = ctypes.c_ssize_t
+
+    def sendfile(out_fd, in_fd, offset, count):
+        c_offset = ctypes.c_int64(offset)
+        sent = libc_sendfile(out_fd, in_fd, ctypes.byref(c_offset), count)
+        if sent < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        return sent
+    return sendfile
+
+
+def _write_fd(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def _copy_range(in_fd, out_fd, start, end, sendfile):
+    # Copies [start, end) of in_fd to out_fd, in the kernel if we can
+    offset = start
+    while sendfile and offset < end:
+        try:
+            sent = sendfile(out_fd, in_fd, offset,
+                            min(end - offset, SENDFILE_CHUNK))
+        except OSError as e:
+            if e.errno in (errno.EINVAL, errno.ENOSYS):
+                # Not supported for this pair of files after all
+                break
+            raise
+        if sent == 0:
+            # Shrank underneath us
+            return
+        offset += sent
+    os.lseek(in_fd, offset, os.SEEK_SET)
+    while offset < end:
+        data = os.read(in_fd, min(end - offset, CAT_BUFFER_SIZE))
+        if not data:
+            return
+        _write_fd(out_fd, data)
+        offset += len(data)
+
+
+def _parse_byte_range(text):
+    # "START:END", either of which may be left out
+    (start, _, end) = text.partition(":")
+    try:
+        start = int(start or 0)
+        if end:
+            end = int(end)
+        else:
+            end = None
+    except ValueError:
+        raise UsageError("--range must look like START:END, got " + text)
+    if start < 0 or (end is not None and end < start):
+        raise UsageError("--range can't go backwards: " + text)
+    return (start, end)
+
+
+def _dump(files, headers, pick_range, pick_chunks):
+    # Dumps part of each file to stdout, without a trip through python's
+    # buffers. pick_range(path, fd, size) says which part: (start, end).
+    # Compressed files can't be cut up by offset, so for them
+    # pick_chunks(path, chunks) picks from the decompressed stream instead.
+    inflaters = Inflaters(files)
+    sys.stdout.flush()
+    out_fd = sys.stdout.fileno()
+    out_mode = os.fstat(out_fd).st_mode
+    if stat.S_ISREG(out_mode) or stat.S_ISFIFO(out_mode):
+        sendfile = _find_sendfile()
+    else:
+        sendfile = None
+    ok = True
+    try:
+        for (i, path) in enumerate(files):
+            if _is_compressed(path):
+                ok = _dump_compressed(i, path, headers, out_fd,
+                                      pick_chunks(path,
+                                                  inflaters.chunks(path))) \
+                    and ok
+                continue
+            try:
+                in_fd = os.open(path, os.O_RDONLY)
+            except OSError as e:
+                error("Can't read %s: %s" % (path, e.strerror))
+                ok = False
+                continue
+            try:
+                (start, end) = pick_range(path, in_fd,
+                                          os.fstat(in_fd).st_size)
+                if headers:
+                    _write_fd(out_fd, "%s==> %s <==\n" %
+                              (i > 0 and "\n" or "", path))
+                _copy_range(in_fd, out_fd, start, end, sendfile)
+            finally:
+                os.close(in_fd)
+    except OSError as e:
+        # Whoever we were writing to (say, head) has had enough
+        if e.errno != errno.EPIPE:
+            raise
+    return ok
+
+
+def _dump_compressed(i, path, headers, out_fd, chunks):
+    if headers:
+        _write_fd(out_fd, "%s==> %s <==\n" % (i > 0 and "\n" or "", path))
+    try:
+        for chunk in chunks:
+            _write_fd(out_fd, chunk)
+    except IOError as e:
+        error("Can't read %s: %s" % (path, e))
+        return False
+    return True
+
+
+def _slice_chunks(chunks, start, end):
+    # Bytes [start, end) of the stream
+    offset = 0
+    for chunk in chunks:
+        if end is not None and offset >= end:
+            return
+        if offset + len(chunk) > start:
+            yield chunk[max(0, start - offset):
+                        end is not None and end - offset or None]
+        offset += len(chunk)
+
+
+def _cat(files, headers=False, byte_range=(0, None)):
+    def pick_range(path, fd, size):
+        (start, end) = byte_range
+        if end is None or end > size:
+            end = size
+        return (min(start, end), end)
+
+    def pick_chunks(path, chunks):
+        return _slice_chunks(chunks, *byte_range)
+    return _dump(files, headers, pick_range, pick_chunks)
+
+
+class _TimeWindow:
+    # For files we can't index (compressed ones): picks the lines from since
+    # up to and including until while reading, like LogIndex.find would
+
+    def __init__(self, parser, since, until):
+        self.parser = parser
+        self.since = since
+        self.until = until
+
+    def select(self, lines):
+        # Yields (timestamp, line) for the lines in the window
+        stamper = _StampedLines(self.parser)
+        started = not self.since
+        for line in lines:
+            stamp = stamper.stamp(line)
+            if not started:
+                if stamp < self.since:
+                    continue
+                started = True
+            if self.until and stamp > self.until:
+                return
+            yield (stamp, line)
+
+
+def _stamped_lines(path, parser, index, prefix, window=(0, None)):
+    # Yields (timestamp, index, line number, text) for each line in the
+    # window of byte offsets (or _TimeWindow), reading as it goes
+    if _is_compressed(path):
+        inflater = _Inflater(path)
+        inflater.start()
+        if not isinstance(window, _TimeWindow):
+            window = _TimeWindow(parser, None, None)
+        stamped = window.select(_iter_lines(inflater.chunks()))
+        try:
+            for (line_no, (stamp, line)) in enumerate(stamped):
+                yield (stamp, index, line_no,
+                       prefix + line.rstrip("\n") + "\n")
+        except IOError as e:
+            error("Can't read %s: %s" % (path, e))
+        return
+    stamper = _StampedLines(parser)
+    (offset, end) = window
+    with open(path, "rb") as f:
+        f.seek(offset)
+        for (line_no, line) in enumerate(f):
+            offset += len(line)
+            if end is not None and offset > end:
+                return
+            line = line.rstrip("\n")
+            yield (stamper.stamp(line), index, line_no, prefix + line + "\n")
+
+
+def _cat_merged(services, log_type, windows=None):
+    # One timeline from all the files (each of which is already in order),
+    # by a k-way merge that holds one line per file at a time
+    import heapq
+    width = max(len(s.name) for s in services)
+    streams = []
+    for (i, service) in enumerate(services):
+        prefix = _line_prefix(service.name, i, width)
+        parser = TimestampParser(service.log_timestamp_formats)
+        for path in service.resolve_logs_relative_to_cwd(log_type, True):
+            streams.append(_stamped_lines(path, parser, len(streams), prefix,
+                                          windows and windows[path] or
+                                          (0, None)))
+    out = sys.stdout
+    try:
+        for (_, _, _, text) in heapq.merge(*streams):
+            out.write(text)
+        out.flush()
+    except IOError as e:
+        # Whoever we were writing to (say, head) has had enough
+        if e.errno != errno.EPIPE:
+            raise
+    return True
+
+
+# What --since and --until understand, besides "10m" (etc.) ago
+TIME_ARG_FORMATS = ["%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S",
+                    "%Y-%m-%d %H:%M", "%Y-%m-%d"]
+TIME_ARG_UNITS = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60}
+
+
+def _parse_time_arg(option, text):
+    import datetime
+    ago = re.match(r"^(\d+)([smhd])$", text)
+    if ago:
+        return (datetime.datetime.now() - datetime.timedelta(
+            seconds=int(ago.group(1)) * TIME_ARG_UNITS[ago.group(2)]))
+    for fmt in TIME_ARG_FORMATS:
+        try:
+            return datetime.datetime.strptime(text, fmt)
+        except ValueError:
+            pass
+    raise UsageError("%s must be a time like '2015-06-01 12:30' or an age "
+                     "like 10m, 2h or 1d; got '%s'" % (option, text))
+
+
+def _time_windows(services, log_type, cache_dir, since, until):
+    # {path: (start, end)} for the lines of each log from since to until
+    # ({path: _TimeWindow} for compressed logs, which we scan instead)
+    windows = {}
+    for service in services:
+        for path in service.resolve_logs_relative_to_cwd(log_type, True):
+            if _is_compressed(path):
+                windows[path] = _TimeWindow(
+                    TimestampParser(service.log_timestamp_formats),
+                    since, until)
+                continue
+            try:
+                index = LogIndex.open(cache_dir, path,
+                                      service.log_timestamp_formats)
+                windows[path] = index.find(since, until)
+            except IOError as e:
+                error("Can't read %s: %s" % (path, e.strerror))
+                windows[path] = (0, 0)
+    return windows
+
+
+def _cat_windows(files, windows):
+    def pick_range(path, fd, size):
+        (start, end) = windows[path]
+        return (min(start, size), min(end, size))
+
+    def pick_chunks(path, chunks):
+        return (line for (_, line)
+                in windows[path].select(_iter_lines(chunks)))
+    return _dump(files, False, pick_range, pick_chunks)
+
+
+def _last(files, lines=None, num_bytes=None):
+    # Like tail (without -f): the end of each file, grouped by file
+    def pick_range(path, fd, size):
+        if num_bytes is not None:
+            return (max(0, size - num_bytes), size)
+        return (_last_lines_offset(fd, size, lines), size)
+
+    def pick_chunks(path, chunks):
+        # No way to start from the end, so read it all and keep the tail
+        if num_bytes is not None:
+            tail = ""
+            for chunk in chunks:
+                tail = (tail + chunk)[-num_bytes:]
+            return num_bytes and [tail] or []
+        return deque(_iter_lines(chunks), lines)
+    return _dump(files, True, pick_range, pick_chunks)
+
+
+##############################################
+# Log search
+##############################################
+
+# Don't bother starting a process pool for fewer files than this
+GREP_MIN_FILES_FOR_POOL = 2
+
+
+def _required_literal(pattern):
+    # The longest string that every match of the regex must contain, or ""
+    # if we can't tell. Only looks at runs of plain characters at the top
+    # level of the parsed pattern; anything else (classes, repeats, groups,
+    # escapes like \d) just ends the run.
+    import sre_constants
+    import sre_parse
+    parsed = sre_parse.parse(pattern)
+    if parsed.pattern.flags & re.IGNORECASE:
+        return ""
+    runs = [""]
+    for (op, value) in parsed:
+        if op == sre_constants.LITERAL and value < 256:
+            runs[-1] += chr(value)
+        else:
+            runs.append("")
+    return max(runs, key=len)
+
+
+_grep_regexes = {}
+
+
+def _grep_file(job):
+    # Runs in a worker process. Returns (path, [(line number, line)], error)
+    import mmap
+    (path, pattern, literal) = job
+    if pattern not in _grep_regexes:
+        _grep_regexes[pattern] = re.compile(pattern)
+    regex = _grep_regexes[pattern]
+    matches = []
+    if _is_compressed(path):
+        return _grep_compressed(path, regex, literal)
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return (path, matches, None)
+            data = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError) as e:
+        return (path, matches, str(e))
+    try:
+        if literal:
+            # Only lines containing the literal can match, and finding those
+            # is a memchr-speed scan of the mapping
+            line_no = 1
+            counted_to = 0
+            pos = data.find(literal)
+            while pos >= 0:
+                start = data.rfind("\n", 0, pos) + 1
+                end = data.find("\n", pos)
+                if end < 0:
+                    end = size
+                line = data[start:end]
+                if regex.search(line):
+                    line_no += data[counted_to:start].count("\n")
+                    counted_to = start
+                    matches.append((line_no, line))
+                pos = data.find(literal, end)
+        else:
+            for (line_no, line) in enumerate(iter(data.readline, ""), 1):
+                line = line.rstrip("\n")
+                if regex.search(line):
+                    matches.append((line_no, line))
+    finally:
+        data.close()
+    return (path, matches, None)
+
+
+def _grep_compressed(path, regex, literal):
+    # Each worker decompresses its own file, so files overlap with each other
+    import zlib
+    matches = []
+    try:
+        stream = _open_decompressed(path)
+        try:
+            for (line_no, line) in enumerate(stream, 1):
+                if literal and literal not in line:
+                    continue
+                line = line.rstrip("\n")
+                if regex.search(line):
+                    matches.append((line_no, line))
+        finally:
+            stream.close()
+    except (IOError, OSError, EOFError, ValueError, zlib.error) as e:
+        return (path, matches, str(e))
+    return (path, matches, None)
+
+
+def _grep(services, log_type, pattern):
+    # Searches every log of the services, in parallel. Returns (whether
+    # anything matched, whether every file could be searched).
+    try:
+        re.compile(pattern)
+    except re.error as e:
+        raise UsageError("Bad pattern: %s" % e)
+    literal = _required_literal(pattern)
+    width = max(len(s.name) for s in services)
+    jobs = []
+    prefixes = {}
+    for (i, service) in enumerate(services):
+        for path in service.resolve_logs_relative_to_cwd(log_type, True):
+            if path not in prefixes:
+                prefixes[path] = _line_prefix(service.name, i, width)
+                jobs.append((path, pattern, literal))
+
+    pool = None
+    if len(jobs) >= GREP_MIN_FILES_FOR_POOL:
+        import multiprocessing
+        pool = multiprocessing.Pool(min(len(jobs),
+                                        multiprocessing.cpu_count()))
+        results = pool.imap(_grep_file, jobs)
+    else:
+        results = itertools.imap(_grep_file, jobs)
+
+    found = False
+    ok = True
+    try:
+        for (path, matches, problem) in results:
+            if problem:
+                error("Can't search %s: %s" % (path, problem))
+                ok = False
+            if matches:
+                found = True
+                _write_whole(sys.stdout, "".join(
+                    "%s%s:%d:%s\n" % (prefixes[path], path, line_no, line)
+                    for (line_no, line) in matches))
+    except IOError as e:
+        # Whoever we were writing to (say, head) has had enough
+        if e.errno != errno.EPIPE:
+            raise
+    finally:
+        if pool:
+            pool.terminate()
+    return (found, ok)
+
+
 ##############################################
 # Customized ArgumentParser
 ##############################################
 
 class MyArgParser(argparse.ArgumentParser):
+    def parse_args(self, args=None, namespace=None):
+        if args is None:
+            args = sys.argv[1:]
+        exclusions = []
+        if "service" in [action.dest for action in self._actions]:
+            # In "ads up all -slow", -slow isn't an option but an exclusion.
+            # Take those out first: argparse would read -jenkins as -j
+            # enkins.
+            (args, exclusions) = self._split_exclusions(args)
+        (parsed, extras) = self.parse_known_args(args, namespace)
+        if extras:
+            self.error("unrecognized arguments: %s" % " ".join(extras))
+        if exclusions:
+            parsed.service = parsed.service + exclusions
+        return parsed
+
+    def _split_exclusions(self, args):
+        rest = []
+        exclusions = []
+        for (i, arg) in enumerate(args):
+            if arg == "--":
+                rest += args[i:]
+                break
+            if arg.startswith("-") and not arg.startswith("--") and \
+                    len(arg) > 1 and not self._reads_as_options(arg) and \
+                    not self._negative_number_matcher.match(arg):
+                # (argparse takes a negative number as a value, like the
+                # -3 in --last -3)
+                exclusions.append(arg)
+            else:
+                rest.append(arg)
+        return (rest, exclusions)
+
+    def _reads_as_options(self, arg):
+        # Whether arg is one of our short options, or several run together
+        # (-vw), maybe ending with one that takes the rest as its value (-j4)
+        if arg in self._option_string_actions:
+            return True
+        for (i, flag) in enumerate(arg[1:]):
+            action = self._option_string_actions.get("-" + flag)
+            if action is None:
+                return False
+            if action.nargs != 0:
+                value = arg[i + 2:]
+                if not value:
+                    # It's the next argument
+                    return True
+                try:
+                    (action.type or str)(value)
+                except (TypeError, ValueError):
+                    return False
+                return True
+        return True
+
     def error(self, message):
         if "too few arguments" in message:
             # Default behavior of "ads" is too punishing
@@ -545,49 +3128,210 @@ class SomeDown(AdsCommandException):
         super(SomeDown, self).__init__(23)
 
 
-def _load_or_die():
-    ads = Ads.load_from_env()
+# Like grep's exit statuses
+class NoMatches(AdsCommandException):
+    def __init__(self):
+        super(NoMatches, self).__init__(1)
+
+
+class SearchFailed(AdsCommandException):
+    def __init__(self, msg):
+        super(SearchFailed, self).__init__(2, msg)
+
+
+def _load_or_die(parsed_args):
+    ads = Ads.load_from_env(parsed_args.rescan)
     if not ads:
         raise UsageError(
             "ads must be run from within an ads project. "
             "See README for more.")
+    _use_shell_engine(ads.get_shell_engine())
     return ads
 
 
-def _tail(files):
-    status = _shell("tail -F " + " \\\n\t".join(files), os.curdir)[0]
-    return (status == 0 or
-            status == 47)  # tail was ended by ctrl+c (Mac OS)
-
-
-def _cat(files):
-    return _shell("cat " + " ".join(files), os.curdir)[0] == 0
+# Like tail, start by showing the last few lines of each log
+FOLLOW_BACKLOG_LINES = 10
+# Even with inotify, look for new directories this often
+FOLLOW_RESCAN_INTERVAL = 1.0
+
+
+def _follow(services, log_type, merge=False):
+    # With merge, each batch of new lines is put in timestamp order before
+    # it's shown. (Lines that turn up later can't go back in time.)
+    services = [s for s in services if s.get_log_globs(log_type)]
+    width = max(len(s.name) for s in services)
+    followers = [
+        (_line_prefix(s.name, i, width),
+         LogFollower(lambda s=s: s.resolve_logs_relative_to_cwd(log_type),
+                     backlog_lines=FOLLOW_BACKLOG_LINES),
+         TimestampParser(s.log_timestamp_formats))
+        for (i, s) in enumerate(services)]
+    log_globs = sum([s.get_log_globs(log_type) for s in services], [])
+    stampers = {}
+    watcher = DirWatcher()
+    try:
+        while True:
+            watcher.watch(_watch_dirs(log_globs))
+            batch = []
+            for (prefix, follower, parser) in followers:
+                for (path, lines) in follower.read_lines():
+                    if merge and path not in stampers:
+                        stampers[path] = _StampedLines(parser)
+                    for line in lines:
+                        stamp = merge and stampers[path].stamp(line) or None
+                        batch.append((stamp, len(batch), prefix + line))
+            if merge:
+                batch.sort()
+            _write_whole(sys.stdout,
+                         "".join(line + "\n" for (_, _, line) in batch))
+            watcher.wait(FOLLOW_RESCAN_INTERVAL)
+    except KeyboardInterrupt:
+        pass
+    except IOError as e:
+        # Whoever we were writing to (say, head) has had enough
+        if e.errno != errno.EPIPE:
+            raise
+    finally:
+        watcher.close()
+    return True
 
 
 def _status(service, verbose):
-    if not service.status_cmd:
+    if not service.can_check_status():
         running = False
         msg = "status command not defined"
     else:
         if verbose:
             debug("Checking if %s is running" % service.name)
-        running = _shell(service.status_cmd,
-                         service.home,
-                         verbose and STREAM or NULL)[0] == 0
+        running = _is_running(service, verbose)
         msg = running and "ok" or "not running"
     info(service.name + ": " + msg)
     return running
 
 
+def _status_all(services, verbose, jobs):
+    if verbose:
+        # Run one at a time so each status command's output is attributable
+        return _for_each_service(lambda sp: _status(sp, verbose),
+                                 services, jobs)
+
+    # Declarative checks run in-process; status commands are batched
+    checked = [s for s in services if s.status_check]
+    running_by_name = dict(zip(
+        [s.name for s in checked],
+        _for_each_service(lambda s: s.status_check.is_running(s.home),
+                          checked, jobs)))
+    probed = [s for s in services if s.status_cmd and not s.status_check]
+    running_by_name.update(zip(
+        [s.name for s in probed],
+        [status == 0 for status in _probe_all(
+            [(s.status_cmd, s.home) for s in probed], jobs)]))
+    results = []
+    for service in services:
+        if not service.can_check_status():
+            running = False
+            msg = "status command not defined"
+        else:
+            running = running_by_name[service.name]
+            msg = running and "ok" or "not running"
+        info(service.name + ": " + msg)
+        results.append(running)
+    return results
+
+
 def _is_running(service, verbose):
+    if service.status_check:
+        return service.status_check.is_running(service.home, verbose)
     return _shell(service.status_cmd,
                   service.home,
                   verbose and STREAM or NULL)[0] == 0
 
 
-def _up(service, verbose):
+POLL_FIRST_INTERVAL = 0.05
+POLL_MAX_INTERVAL = 1.0
+# Process table snapshots younger than this are shared between pollers
+POLL_TICK = 0.025
+# Checking a log is cheap, so there's no need to back off as far
+LOG_POLL_INTERVAL = 0.1
+
+
+def _poll(predicate, timeout, max_interval=POLL_MAX_INTERVAL):
+    # Calls predicate until it returns True or timeout seconds pass, backing
+    # off exponentially (with jitter, so concurrent pollers spread out)
+    import random
+    deadline = time.time() + timeout
+    interval = min(POLL_FIRST_INTERVAL, max_interval)
+    while True:
+        if predicate():
+            return True
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(remaining, interval * random.uniform(0.75, 1.25)))
+        interval = min(interval * 2, max_interval)
+
+
+def _is_running_now(service):
+    # For pollers: don't trust a process table from before the last tick
+    _invalidate_process_table(POLL_TICK)
+    return _is_running(service, False)
+
+
+def _log_says_ready(follower, pattern):
+    regex = re.compile(pattern)
+    return lambda: any(regex.search(line)
+                       for (_, lines) in follower.read_lines()
+                       for line in lines)
+
+
+def _wait_until_ready(services, started_at, followers, timeout):
+    # Polls every service concurrently against one deadline: by watching its
+    # logs if we have a LogFollower for it, otherwise with its status check.
+    # Returns a list of booleans in service order.
+    deadline = time.time() + timeout
+    report_lock = threading.Lock()
+
+    def wait_for(i, service):
+        try:
+            if service.name in followers:
+                ready = _poll(_log_says_ready(followers[service.name],
+                                              service.ready_log_pattern),
+                              max(0, deadline - time.time()),
+                              LOG_POLL_INTERVAL)
+            else:
+                ready = _poll(lambda: _is_running_now(service),
+                              max(0, deadline - time.time()))
+        except Exception as e:
+            # One broken waiter shouldn't take the others down with it
+            with report_lock:
+                error("Couldn't tell whether %s is ready: %s" %
+                      (service.name, e))
+            return
+        with report_lock:
+            if ready:
+                info("%s is ready (%.2fs)" %
+                     (service.name, time.time() - started_at[service.name]))
+            else:
+                error("%s is not ready after %gs" % (service.name, timeout))
+        results[i] = ready
+
+    # Anything that never reports back counts as not ready
+    results = [False] * len(services)
+    threads = [threading.Thread(target=wait_for, args=(i, service))
+               for (i, service) in enumerate(services)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        # (Join with a timeout so ctrl+c still works)
+        while thread.is_alive():
+            thread.join(0.1)
+    return results
+
+
+def _up(service, verbose, on_start=None):
     # Is it running?
-    if not service.status_cmd:
+    if not service.can_check_status():
         error("Status command not defined for " + service.name +
               "; can't tell if it's already running")
         return False
@@ -604,8 +3348,11 @@ def _up(service, verbose):
 
     # Do it
     info("Starting " + service.name)
+    if on_start:
+        on_start(service)
     (status, out) = _shell(service.start_cmd, service.home,
                            verbose and STREAM or BUFFER)
+    _invalidate_process_table()
     if status == 0:
         if verbose:
             debug("Started " + service.name)
@@ -613,7 +3360,7 @@ def _up(service, verbose):
     else:
         error("Failed to start " + service.name)
         if not verbose:
-            sys.stderr.write(out)
+            error_output(out)
             error(separator())
         else:
             # Output was already streamed
@@ -623,7 +3370,7 @@ def _up(service, verbose):
 
 def _down(service, verbose):
     # Is it running?
-    if not service.status_cmd:
+    if not service.can_check_status():
         error("Status command not defined for " + service.name +
               "; can't tell if it's already stopped")
         return False
@@ -639,43 +3386,122 @@ def _down(service, verbose):
         return False
 
     # Do it
-    attempts = 0
     info("Stopping %s" % service.name)
-    while True:
-        (status, out) = _shell(service.stop_cmd, service.home,
-                               verbose and STREAM or BUFFER)
-        attempts = attempts + 1
+    start_time = time.time()
+    if not _run_stop_cmd(service.stop_cmd, "Stop", service, verbose):
+        return False
+    if _wait_until_stopped(service, verbose):
+        if verbose:
+            debug("Stopped %s in %.2fs" %
+                  (service.name, time.time() - start_time))
+        return True
 
-        if status == 0:
-            if verbose:
-                debug("Stop command succeeded")
-        else:
-            error("Stop command failed")
-            if not verbose:
-                sys.stderr.write(out)
-                error(separator())
-            else:
-                # Output was already streamed
-                pass
-            return False
+    # Didn't take; escalate if we can
+    if not service.force_stop_cmd:
+        error(("Stop command succeeded, but status says %s " +
+               "is still running after %gs. Either it needs a longer " +
+               "stop_timeout or a force_stop_cmd, or this is a bug in " +
+               "your ads.yml. Try with -v to debug.")
+              % (service.name, service.stop_timeout))
+        return False
+    if verbose:
+        debug("%s is still running after %gs; forcing it to stop" %
+              (service.name, service.stop_timeout))
+    if not _run_stop_cmd(service.force_stop_cmd, "Force stop", service,
+                         verbose):
+        return False
+    if _wait_until_stopped(service, verbose):
+        if verbose:
+            debug("Stopped %s (forcibly) in %.2fs" %
+                  (service.name, time.time() - start_time))
+        return True
+    error("Force stop command succeeded, but status says %s is still "
+          "running. This is a bug in your ads.yml." % service.name)
+    return False
 
-        if not _is_running(service, verbose):
-            if verbose:
-                debug("Status says %s is down" % service.name)
-            return True
 
-        elif attempts > 10:
-            error(("Stop command succeeded, but status says %s " +
-                   "is still running. This is a bug in your ads.yml. " +
-                   "If you can reproduce this, try with -v to debug.")
-                  % service.name)
-            return False
+def _run_stop_cmd(cmd, label, service, verbose):
+    (status, out) = _shell(cmd, service.home, verbose and STREAM or BUFFER)
+    _invalidate_process_table()
+    if status == 0:
+        if verbose:
+            debug("%s command succeeded" % label)
+        return True
+    error("%s command failed" % label)
+    if not verbose:
+        error_output(out)
+        error(separator())
+    else:
+        # Output was already streamed
+        pass
+    return False
 
-        else:
-            if verbose:
-                debug("%s is still running after stop command; retrying" %
-                      service.name)
-            time.sleep(0.5)
+
+def _wait_until_stopped(service, verbose):
+    checks = [0]
+
+    def is_stopped():
+        checks[0] += 1
+        return not _is_running_now(service)
+
+    stopped = _poll(is_stopped, service.stop_timeout)
+    if verbose:
+        debug("Status says %s is %s (checked %d times)" %
+              (service.name, stopped and "down" or "still running",
+               checks[0]))
+    return stopped
+
+
+def _for_each_service(func, services, jobs):
+    # Calls func(service) for every service, at most jobs at a time, and
+    # returns the results in service order. Whatever each call reports is
+    # held back and replayed in service order, so the output reads the
+    # same as it would have sequentially.
+    if jobs <= 1 or len(services) <= 1:
+        return map(func, services)
+
+    results = [False] * len(services)
+    reports = [None] * len(services)
+    prefix_width = max(len(s.name) for s in services)
+    finished = [threading.Event() for _ in services]
+    next_index = iter(range(len(services)))
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            with lock:
+                i = next(next_index, None)
+            if i is None:
+                return
+            _reports.buffer = []
+            # Output of -v commands is interleaved live, so label it
+            _reports.prefix = _line_prefix(services[i].name, i, prefix_width)
+            try:
+                results[i] = func(services[i])
+            except Exception as e:
+                error("Unexpected error handling %s: %s" %
+                      (services[i].name, e))
+            reports[i] = _reports.buffer
+            _reports.buffer = None
+            _reports.prefix = None
+            finished[i].set()
+
+    for _ in range(min(jobs, len(services))):
+        worker = threading.Thread(target=work)
+        worker.daemon = True
+        worker.start()
+
+    for i in range(len(services)):
+        while not finished[i].wait(0.1):
+            # A timeout keeps ctrl+c working on python 2
+            pass
+        for (stream, text) in reports[i]:
+            _emit(stream, text)
+    return results
+
+
+def _failed_names(services, results):
+    return ", ".join(s.name for (s, ok) in zip(services, results) if not ok)
 
 
 def _collect_rel_homes(services):
@@ -689,6 +3515,29 @@ def _add_verbose_arg(parser):
         help="show output of commands that ads delegates to")
 
 
+def _add_jobs_arg(parser):
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        metavar="N",
+        help="act on up to N services at once (default: 'jobs' from "
+             "~/.ads_profile.yml or adsroot.yml, else 1)")
+
+
+def _get_jobs(ads, parsed_args):
+    if parsed_args.jobs is not None and parsed_args.jobs < 1:
+        raise UsageError("--jobs must be at least 1")
+    return ads.get_jobs(parsed_args.jobs)
+
+
+def _add_rescan_arg(parser):
+    parser.add_argument(
+        "--rescan",
+        action="store_true",
+        help="ignore the cached project manifest and rescan the whole tree "
+             "for ads.yml files")
+
+
 def _add_services_arg(parser):
     parser.add_argument(
         "service",
@@ -701,14 +3550,16 @@ def _resolve_selectors(ads, selectors, fail_if_empty):
         selectors = ["default"]
 
     try:
-        service_names = reduce(frozenset.__or__,
-                               [ads.resolve(s) for s in selectors])
+        # Together, the selectors are one big selector, so "all -slow" works
+        # whether or not it was quoted
+        service_names = ads.resolve(" ".join(selectors))
     except BadSelectorException as e:
         raise NotFound(str(e))
 
     services = map(
         lambda name: ads.project.services_by_name[name],
         sorted(service_names))
+    ads.project.load_services(services)
 
     if fail_if_empty and len(services) == 0:
         raise NotFound("No services found that match '%s'" %
@@ -717,10 +3568,10 @@ def _resolve_selectors(ads, selectors, fail_if_empty):
     return services
 
 
-def _collect_logs_nonempty(services, log_type):
+def _collect_logs_nonempty(services, log_type, with_rotated=False):
     all_logs = []
     for s in services:
-        all_logs += s.resolve_logs_relative_to_cwd(log_type)
+        all_logs += s.resolve_logs_relative_to_cwd(log_type, with_rotated)
 
     if len(all_logs) == 0:
         raise NotFound("No %s log files found for services %s" %
@@ -731,62 +3582,117 @@ def _collect_logs_nonempty(services, log_type):
 
 def list_func(args):
     parser = MyArgParser(prog=cmd_list.name, description=cmd_list.description)
-    parser.parse_args(args)
-    ads = _load_or_die()
+    _add_rescan_arg(parser)
+    parsed_args = parser.parse_args(args)
+    ads = _load_or_die(parsed_args)
     ads.list()
 
 
+DEFAULT_WAIT_TIMEOUT = 60
+
+
 def up(args):
     parser = MyArgParser(prog=cmd_up.name, description=cmd_up.description)
     _add_verbose_arg(parser)
+    parser.add_argument(
+        "--wait",
+        action="store_true",
+        help="after starting, wait until status says every service is up")
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        metavar="SECONDS",
+        help="with --wait, give up after this long (default: %d)" %
+             DEFAULT_WAIT_TIMEOUT)
+    _add_jobs_arg(parser)
+    _add_rescan_arg(parser)
     _add_services_arg(parser)
     parsed_args = parser.parse_args(args)
-    ads = _load_or_die()
+    ads = _load_or_die(parsed_args)
     services = _resolve_selectors(ads, parsed_args.service, True)
     if len(services) > 1:
         info("Starting " + str(services))
-    if not all(map(lambda sp: _up(sp, parsed_args.verbose), services)):
-        raise StartFailed("One or more services failed to start")
+    if parsed_args.timeout is not None and not parsed_args.wait:
+        raise UsageError("--timeout only makes sense with --wait")
+    started_at = {}
+    followers = {}
+
+    def follow_logs(service):
+        # Start following before the service can write anything
+        if parsed_args.wait and service.ready_log_pattern:
+            followers[service.name] = LogFollower(
+                lambda: service.resolve_logs_relative_to_cwd("general"))
+
+    def start(service):
+        started_at[service.name] = time.time()
+        return _up(service, parsed_args.verbose, follow_logs)
+
+    results = _for_each_service(start, services, _get_jobs(ads, parsed_args))
+    if not all(results):
+        raise StartFailed("One or more services failed to start: " +
+                          _failed_names(services, results))
+
+    if parsed_args.wait:
+        timeout = parsed_args.timeout
+        if timeout is None:
+            timeout = DEFAULT_WAIT_TIMEOUT
+        ready = _wait_until_ready(services, started_at, followers, timeout)
+        if not all(ready):
+            raise StartFailed("One or more services did not become ready: " +
+                              _failed_names(services, ready))
 
 
 def down(args):
     parser = MyArgParser(prog=cmd_down.name, description=cmd_down.description)
     _add_verbose_arg(parser)
+    _add_jobs_arg(parser)
+    _add_rescan_arg(parser)
     _add_services_arg(parser)
     parsed_args = parser.parse_args(args)
-    ads = _load_or_die()
+    ads = _load_or_die(parsed_args)
     services = _resolve_selectors(ads, parsed_args.service, True)
-    if not all(map(lambda sp: _down(sp, parsed_args.verbose), services)):
-        raise StopFailed("One or more services failed to stop")
+    results = _for_each_service(lambda sp: _down(sp, parsed_args.verbose),
+                                services, _get_jobs(ads, parsed_args))
+    if not all(results):
+        raise StopFailed("One or more services failed to stop: " +
+                         _failed_names(services, results))
 
 
 def bounce(args):
     parser = MyArgParser(prog=cmd_bounce.name,
                          description=cmd_bounce.description)
     _add_verbose_arg(parser)
+    _add_jobs_arg(parser)
+    _add_rescan_arg(parser)
     _add_services_arg(parser)
     parsed_args = parser.parse_args(args)
-    ads = _load_or_die()
+    ads = _load_or_die(parsed_args)
     services = _resolve_selectors(ads, parsed_args.service, True)
-    all_stopped = all(
-        map(lambda sp: _down(sp, parsed_args.verbose), services))
-    all_started = all(
-        map(lambda sp: _up(sp, parsed_args.verbose), services))
-    if not all_stopped:
-        raise StopFailed("One or more services failed to stop")
-    if not all_started:
-        raise StartFailed("One or more services failed to restart")
+    jobs = _get_jobs(ads, parsed_args)
+    stopped = _for_each_service(lambda sp: _down(sp, parsed_args.verbose),
+                                services, jobs)
+    started = _for_each_service(lambda sp: _up(sp, parsed_args.verbose),
+                                services, jobs)
+    if not all(stopped):
+        raise StopFailed("One or more services failed to stop: " +
+                         _failed_names(services, stopped))
+    if not all(started):
+        raise StartFailed("One or more services failed to restart: " +
+                          _failed_names(services, started))
 
 
 def status(args):
     parser = MyArgParser(prog=cmd_status.name,
                          description=cmd_status.description)
     _add_verbose_arg(parser)
+    _add_jobs_arg(parser)
+    _add_rescan_arg(parser)
     _add_services_arg(parser)
     parsed_args = parser.parse_args(args)
-    ads = _load_or_die()
+    ads = _load_or_die(parsed_args)
     services = _resolve_selectors(ads, parsed_args.service, False)
-    if not all(map(lambda sp: _status(sp, parsed_args.verbose), services)):
+    if not all(_status_all(services, parsed_args.verbose,
+                           _get_jobs(ads, parsed_args))):
         raise SomeDown()
 
 
@@ -796,7 +3702,8 @@ def logs(args):
     sub_cmd_gp.add_argument(
         "--tail",
         action="store_true",
-        help="(Default) Follow the logs with tail -f")
+        help="(Default) Follow the logs, labeling each line with its "
+             "service")
     sub_cmd_gp.add_argument(
         "--list",
         action="store_true",
@@ -806,6 +3713,22 @@ def logs(args):
         "--cat",
         action="store_true",
         help="Dump the contents of all log files to stdout")
+    sub_cmd_gp.add_argument(
+        "--grep",
+        metavar="PATTERN",
+        help="Search all log files for lines matching a (Python) regular "
+             "expression. Exits like grep: 0 if any matched, 1 if none did, "
+             "2 on errors")
+    sub_cmd_gp.add_argument(
+        "--last",
+        type=int,
+        metavar="N",
+        help="Show the last N lines of each log file")
+    sub_cmd_gp.add_argument(
+        "--bytes",
+        type=int,
+        metavar="N",
+        help="Show the last N bytes of each log file")
     which_logs_gp = parser.add_mutually_exclusive_group()
     which_logs_gp.add_argument(
         "--general",
@@ -816,44 +3739,118 @@ def logs(args):
         "--errors",
         action="store_true",
         help="Show the error logs specified by the err_log_paths field")
+    parser.add_argument(
+        "--merge",
+        action="store_true",
+        help="Interleave the lines of all the logs by their timestamps "
+             "(when following, or with --cat)")
+    parser.add_argument(
+        "--since",
+        metavar="TIME",
+        help="With --cat, start at the first line logged at or after TIME "
+             "(like '2015-06-01 12:30', or 10m, 2h, 1d ago)")
+    parser.add_argument(
+        "--until",
+        metavar="TIME",
+        help="With --cat, stop after the last line logged at or before TIME")
+    parser.add_argument(
+        "--headers",
+        action="store_true",
+        help="With --cat, precede each file with a '==> path <==' header")
+    parser.add_argument(
+        "--range",
+        metavar="START:END",
+        help="With --cat, only dump these bytes of each file (either end "
+             "may be left out)")
+    _add_rescan_arg(parser)
     _add_services_arg(parser)
     parsed_args = parser.parse_args(args)
 
+    if not parsed_args.cat and (parsed_args.headers or parsed_args.range):
+        raise UsageError("--headers and --range only work with --cat")
+    byte_range = _parse_byte_range(parsed_args.range or ":")
+    if parsed_args.merge and (parsed_args.list or
+                              parsed_args.grep is not None or
+                              parsed_args.last is not None or
+                              parsed_args.bytes is not None or
+                              parsed_args.headers or parsed_args.range):
+        raise UsageError("--merge only works when following, or with --cat "
+                         "(and without --headers or --range)")
+    since = parsed_args.since and _parse_time_arg("--since",
+                                                  parsed_args.since)
+    until = parsed_args.until and _parse_time_arg("--until",
+                                                  parsed_args.until)
+    if (since or until) and (not parsed_args.cat or parsed_args.headers or
+                             parsed_args.range):
+        raise UsageError("--since and --until only work with --cat "
+                         "(and without --headers or --range)")
+    for (option, value) in [("--last", parsed_args.last),
+                            ("--bytes", parsed_args.bytes)]:
+        if value is not None and value < 0:
+            raise UsageError("%s can't be negative" % option)
+
     if parsed_args.errors:
         log_type = "error"
     else:
         # Default
         log_type = "general"
 
-    ads = _load_or_die()
+    ads = _load_or_die(parsed_args)
     services = _resolve_selectors(ads, parsed_args.service, False)
-    resolved_log_paths = _collect_logs_nonempty(services, log_type)
+    # Following and --last are about what's happening now; everything else
+    # reads the rotated logs too
+    with_rotated = (parsed_args.list or parsed_args.cat or
+                    parsed_args.grep is not None)
+    resolved_log_paths = _collect_logs_nonempty(services, log_type,
+                                                with_rotated)
 
     if parsed_args.list:
         print("\n".join(resolved_log_paths))
+    elif parsed_args.grep is not None:
+        (found, ok) = _grep(services, log_type, parsed_args.grep)
+        if not ok:
+            raise SearchFailed("Couldn't search some of the log files")
+        if not found:
+            raise NoMatches()
+    elif since or until:
+        windows = _time_windows(
+            services, log_type,
+            os.path.join(ads.project.home, CACHE_DIR_NAME, "log_index"),
+            since, until)
+        if parsed_args.merge:
+            _cat_merged(services, log_type, windows)
+        elif not _cat_windows(resolved_log_paths, windows):
+            raise InternalError("Couldn't read some of the log files")
+    elif parsed_args.cat and parsed_args.merge:
+        _cat_merged(services, log_type)
     elif parsed_args.cat:
-        if not _cat(resolved_log_paths):
-            raise InternalError("cat command failed")
+        if not _cat(resolved_log_paths, parsed_args.headers, byte_range):
+            raise InternalError("Couldn't read some of the log files")
+    elif parsed_args.last is not None or parsed_args.bytes is not None:
+        if not _last(resolved_log_paths, parsed_args.last, parsed_args.bytes):
+            raise InternalError("Couldn't read some of the log files")
     else:
         # Default
-        if not _tail(resolved_log_paths):
-            raise InternalError("tail command failed")
+        _follow(services, log_type, parsed_args.merge)
 
 
 def home(args):
     parser = MyArgParser(prog=cmd_home.name, description=cmd_home.description)
+    _add_rescan_arg(parser)
     _add_services_arg(parser)
     parsed_args = parser.parse_args(args)
-    ads = _load_or_die()
+    ads = _load_or_die(parsed_args)
     services = _resolve_selectors(ads, parsed_args.service, True)
     print("\n".join(_collect_rel_homes(services)))
 
 
 def edit(args):
+    import subprocess
     parser = MyArgParser(prog=cmd_edit.name, description=cmd_edit.description)
+    _add_rescan_arg(parser)
     _add_services_arg(parser)
     parsed_args = parser.parse_args(args)
-    ads = _load_or_die()
+    ads = _load_or_die(parsed_args)
     services = _resolve_selectors(ads, parsed_args.service, True)
     homes = _collect_rel_homes(services)
     ymls = [os.path.join(home, "ads.yml") for home in homes]
@@ -949,7 +3946,14 @@ See 'ads help <command>' to read about a specific subcommand.
     return parser
 
 
-main_parser = create_main_arg_parser()
+# Built on first use; most runs go straight to a command and never need it
+_main_parser = []
+
+
+def _get_main_parser():
+    if not _main_parser:
+        _main_parser.append(create_main_arg_parser())
+    return _main_parser[0]
 
 
 def help(args):
@@ -964,7 +3968,7 @@ def help(args):
     if parsed_args.command:
         cmds_by_alias[parsed_args.command].func(["-h"])
     else:
-        main_parser.print_help()
+        _get_main_parser().print_help()
 
 
 cmds_by_alias["help"].func = help
@@ -974,12 +3978,16 @@ def main():
     cmd_args = sys.argv[1:2]
     subcmd_args = sys.argv[2:]
 
-    args = main_parser.parse_args(cmd_args)
-    if args.command == "help" and len(subcmd_args) == 0:
-        main_parser.print_help()
+    if cmd_args and cmd_args[0] in cmds_by_alias:
+        # Nothing for the main parser to check
+        command = cmd_args[0]
+    else:
+        command = _get_main_parser().parse_args(cmd_args).command
+    if command == "help" and len(subcmd_args) == 0:
+        _get_main_parser().print_help()
         return
 
     try:
-        cmds_by_alias[args.command].func(subcmd_args)
+        cmds_by_alias[command].func(subcmd_args)
     except AdsCommandException as e:
         fail(e.exit_code, e.msg)
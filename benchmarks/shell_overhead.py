@@ -0,0 +1,90 @@
+#!/usr/bin/python
+#
+# Measures how long ads takes to run a trivial command through _shell, which
+# is all overhead: process creation plus whatever plumbing we do around it.
+# Compares the current _shell against the old approach of writing the script
+# and (in buffer mode) the output to temp files.
+#
+# The "pool" column runs the same commands on the warm bash workers of the
+# pool shell engine.
+#
+# Also compares probing many status commands one process each against
+# probing them all in one batch.
+#
+# Usage: python benchmarks/shell_overhead.py [iterations]
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from ads.ads import _shell, _probe_all, ShellPool, BUFFER, NULL
+
+
+def _legacy_shell(cmd_str, working_dir, output_mode):
+    if output_mode == BUFFER:
+        out_file = tempfile.NamedTemporaryFile()
+    else:
+        out_file = open(os.devnull, 'w')
+    cmd_file = tempfile.NamedTemporaryFile()
+    cmd_file.write("""
+echo 'cd %s'
+cat <<ADS_EOF
+%s
+ADS_EOF
+%s
+""" % (working_dir, cmd_str, cmd_str))
+    cmd_file.flush()
+    status = subprocess.Popen(
+        ["/bin/bash", cmd_file.name],
+        close_fds=True,
+        cwd=working_dir,
+        stdout=out_file,
+        stderr=out_file).wait()
+    cmd_file.close()
+    if output_mode == BUFFER:
+        out_file.seek(0)
+        output = out_file.read()
+        out_file.close()
+        return status, output
+    return status, None
+
+
+def _time_per_call(shell, output_mode, iterations):
+    working_dir = tempfile.gettempdir()
+    start = time.time()
+    for _ in range(iterations):
+        shell("true", working_dir, output_mode)
+    return (time.time() - start) / iterations * 1000
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    print("ms per command, %d iterations" % iterations)
+    print("%-8s %10s %10s %10s" % ("mode", "before", "after", "pool"))
+    pool = ShellPool(1)
+    for mode in [NULL, BUFFER]:
+        before = _time_per_call(_legacy_shell, mode, iterations)
+        after = _time_per_call(_shell, mode, iterations)
+        pooled = _time_per_call(pool.run, mode, iterations)
+        print("%-8s %10.2f %10.2f %10.2f" % (mode, before, after, pooled))
+    pool.close()
+
+    working_dir = tempfile.gettempdir()
+    probes = [("true", working_dir)] * iterations
+    start = time.time()
+    for (cmd_str, probe_dir) in probes:
+        _shell(cmd_str, probe_dir, NULL)
+    one_each = (time.time() - start) / iterations * 1000
+    start = time.time()
+    _probe_all(probes, 1)
+    batched = (time.time() - start) / iterations * 1000
+    print("%-8s %10.2f %10.2f   (one bash each vs. one batch)" %
+          ("probe", one_each, batched))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/python
+#
+# Measures how long ads takes to start: importing the module, and running
+# a cheap command (ads home) in a small project whose manifest is warm. Each
+# is run in a fresh interpreter, and the median is reported.
+#
+# Also lists the slowest imports, so a new top-level import shows up. Uses
+# -X importtime where the interpreter has it (python 3.7+); otherwise times
+# imports with an __import__ hook.
+#
+# With --max-ms, exits 1 if starting ads home took longer than that.
+#
+# Usage: python benchmarks/startup_time.py [iterations] [--max-ms MS]
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+PROJECT = os.path.join(REPO, "tests", "resources", "one-trivial-service")
+
+HOOKED_IMPORT = """
+import sys, time, __builtin__
+real_import = __builtin__.__import__
+times = {}
+def timed_import(name, *args, **kwargs):
+    if name in sys.modules:
+        return real_import(name, *args, **kwargs)
+    start = time.time()
+    try:
+        return real_import(name, *args, **kwargs)
+    finally:
+        times[name] = max(times.get(name, 0), time.time() - start)
+__builtin__.__import__ = timed_import
+import ads.ads
+__builtin__.__import__ = real_import
+for (name, took) in sorted(times.items(), key=lambda t: -t[1])[:%d]:
+    print("%%8.2f %%s" %% (took * 1000, name))
+"""
+
+
+def _env():
+    env = dict(os.environ)
+    env["PYTHONPATH"] = REPO
+    # Installed copies of ads are byte-compiled
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    return env
+
+
+def _median_ms(args, cwd, iterations):
+    timings = []
+    with open(os.devnull, "w") as devnull:
+        for _ in range(iterations):
+            start = time.time()
+            subprocess.check_call(args, cwd=cwd, env=_env(),
+                                  stdout=devnull, stderr=devnull)
+            timings.append((time.time() - start) * 1000)
+    return sorted(timings)[len(timings) // 2]
+
+
+def _slowest_imports(count):
+    if sys.version_info >= (3, 7):
+        output = subprocess.Popen(
+            [sys.executable, "-X", "importtime", "-c", "import ads.ads"],
+            env=_env(), stderr=subprocess.PIPE).communicate()[1]
+        rows = []
+        for line in output.decode().splitlines()[1:]:
+            (_, cumulative, name) = [f.strip() for f in line.split("|")]
+            rows.append((int(cumulative) / 1000.0, name))
+        return "".join("%8.2f %s\n" % row
+                       for row in sorted(rows, reverse=True)[:count])
+    return subprocess.Popen(
+        [sys.executable, "-c", HOOKED_IMPORT % count],
+        env=_env(), stdout=subprocess.PIPE).communicate()[0].decode()
+
+
+def main():
+    args = sys.argv[1:]
+    max_ms = None
+    if "--max-ms" in args:
+        i = args.index("--max-ms")
+        max_ms = float(args[i + 1])
+        del args[i:i + 2]
+    iterations = int(args[0]) if args else 20
+
+    project = tempfile.mkdtemp()
+    try:
+        for name in os.listdir(PROJECT):
+            src = os.path.join(PROJECT, name)
+            if os.path.isdir(src):
+                shutil.copytree(src, os.path.join(project, name))
+            else:
+                shutil.copy(src, project)
+        # Specs and directories modified in the last couple of seconds are
+        # never trusted from the manifest; real projects are older than that
+        an_hour_ago = time.time() - 60 * 60
+        for (dir_path, _, file_names) in os.walk(project):
+            for name in file_names:
+                os.utime(os.path.join(dir_path, name),
+                         (an_hour_ago, an_hour_ago))
+            os.utime(dir_path, (an_hour_ago, an_hour_ago))
+        ads = [sys.executable, "-c", "from ads.ads import main; main()"]
+        # Compile ads and warm the manifest, which every real run has
+        subprocess.check_call(ads + ["home", "service"], cwd=project,
+                              env=_env(), stdout=open(os.devnull, "w"))
+
+        print("median ms, %d iterations" % iterations)
+        bare = _median_ms([sys.executable, "-c", "pass"], project, iterations)
+        imported = _median_ms([sys.executable, "-c", "import ads.ads"],
+                              project, iterations)
+        home = _median_ms(ads + ["home", "service"], project, iterations)
+        print("%-12s %8.2f" % ("python", bare))
+        print("%-12s %8.2f" % ("import ads", imported))
+        print("%-12s %8.2f" % ("ads home", home))
+        print("")
+        print("slowest imports (ms, including what they import):")
+        sys.stdout.write(_slowest_imports(10))
+    finally:
+        shutil.rmtree(project)
+
+    if max_ms is not None and home > max_ms:
+        print("ads home took %.2fms, more than %.2fms" % (home, max_ms))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
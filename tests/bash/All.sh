@@ -7,6 +7,7 @@ cd "$(dirname "${BASH_SOURCE[0]}")"
 ./Basics.sh
 ./Edit.sh
 ./Help.sh
+./Jobs.sh
 ./Logs.sh
 ./ObscureProjectLayouts.sh
 ./Selectors.sh
@@ -73,27 +73,32 @@ test_down_verbose() {
     assert_fails "ads down" 'Stop command failed' 'kill -9'
 }
 
-test_down_with_retries() {
+test_down_waits_for_stop() {
     go_test_project leaky-stop-cmd
     export LEAKY_STOP_SLEEP=1
     assert_ok "ads up"
-    assert_ok "ads down -v" "retry"
+    assert_ok "ads down -v" "Status says service is down" "Stopped service in"
 
-    # Without retries, we'd see that status still showed true
+    # Without waiting, we'd see that status still showed true
     assert_contains "$(ads status)" "not running"
 }
 
-# Disabled because I noticed it's flaky
-#test_down_but_retries_time_out() {
-#    go_test_project leaky-stop-cmd
-#    export LEAKY_STOP_SLEEP=100
-#    assert_ok "ads up"
-#    assert_fails "ads down -v" "is still running"
-#
-#    # Ok, actually kill it (clean up)
-#    export LEAKY_STOP_SLEEP=0
-#    assert_ok "ads down"
-#}
+test_down_times_out_then_forces() {
+    go_test_project one-trivial-service
+    cat > service/ads.yml << EOF
+start_cmd: bash service.sh > /dev/null 2>&1 &
+stop_cmd: echo "not really stopping"
+status_cmd: pgrep -f service.sh
+stop_timeout: 0.5
+EOF
+    assert_ok "ads up"
+    assert_fails "ads down" "is still running after 0.5s"
+
+    echo "force_stop_cmd: pgrep -f service.sh | xargs kill -9" \
+        >> service/ads.yml
+    assert_ok "ads down -v" "forcing it to stop" "Stopped service (forcibly)"
+    assert_contains "$(ads status)" "not running"
+}
 
 test_bounce_verbose() {
     go_test_project one-trivial-service
@@ -121,6 +126,43 @@ test_bounce_with_retries() {
     assert_ok "ads bounce"
 }
 
+test_up_wait() {
+    go_test_project slow-services
+    cat > alpha/ads.yml << EOF
+start_cmd: (sleep 1 && touch started) > /dev/null 2>&1 &
+status_cmd: test -f started
+EOF
+    cat > bravo/ads.yml << EOF
+start_cmd: (sleep 10 && touch started) > /dev/null 2>&1 &
+status_cmd: test -f started
+EOF
+
+    assert_ok "ads up --wait alpha" "alpha is ready"
+    assert_ok "ads status alpha" "alpha: ok"
+
+    assert_fails "ads up --wait --timeout 0.5 bravo" \
+        "bravo is not ready after 0.5s" "did not become ready: bravo"
+    assert_fails "ads up --timeout 1 bravo" "only makes sense with --wait"
+}
+
+test_up_wait_for_log_pattern() {
+    go_test_project slow-services
+    echo "listening on 1234 (last time)" > alpha.log
+    cat > alpha/ads.yml << EOF
+start_cmd: (sleep 1 && echo "listening on 1234" >> ../alpha.log) &
+status_cmd: test -f started
+log_paths: [../alpha.log]
+ready_log_pattern: listening on \\d+
+EOF
+
+    # Only what's written after we start counts
+    assert_ok "ads up --wait alpha" "alpha is ready"
+    assert_contains "$(cat alpha.log)" "listening on 1234"
+
+    sed -i.bak "s/echo/true/" alpha/ads.yml
+    assert_fails "ads up --wait --timeout 2 alpha" "alpha is not ready"
+}
+
 test_status_verbose() {
     go_test_project one-trivial-service
 
@@ -129,4 +171,56 @@ test_status_verbose() {
     assert_contains "$(ads status --verbose)" 'Checking if' "pgrep"
 }
 
+test_status_commands_are_isolated() {
+    go_test_project slow-services
+    # Each status command runs in its own home, and nothing one of them does
+    # (cd, exit, set variables, read stdin) affects the others
+    cat > alpha/ads.yml << EOF
+status_cmd: cd /; export LEAKED=yes; cat; exit 0
+EOF
+    cat > bravo/ads.yml << EOF
+status_cmd: test -z "\$LEAKED" && test -f ads.yml && echo "it's fine"
+EOF
+
+    assert_ok "ads status alpha bravo" "alpha: ok" "bravo: ok"
+    assert_ok "ads status -j 2 alpha bravo" "alpha: ok" "bravo: ok"
+}
+
+test_status_block() {
+    go_test_project declarative-status
+
+    assert_fails_with_stdout "ads status" "service: not running"
+    assert_ok "ads up service" "Starting service"
+    assert_ok "ads status" "service: ok"
+    assert_ok "ads status -v" "pidfile service.pid: ok" \
+        "process_pattern bash service[.]sh: ok"
+    assert_ok "ads down service" "Stopping service"
+    assert_fails_with_stdout "ads status" "service: not running"
+
+    # A stale pidfile isn't enough
+    echo 999999 > service/service.pid
+    assert_fails_with_stdout "ads status -v" "pidfile service.pid: failed"
+    rm service/service.pid
+
+    echo "    bogus: 1" >> service/ads.yml
+    assert_fails "ads status" "Unknown key in status: bogus"
+}
+
+test_shell_pool() {
+    go_test_project one-trivial-service
+    echo "shell_engine: pool" >> adsroot.yml
+
+    assert_ok "ads up -v service" "Starting service" "bash service.sh"
+    assert_ok "ads status service" "service: ok"
+    assert_ok "ads down service" "Stopping service"
+    assert_fails_with_stdout "ads status service" "service: not running"
+
+    go_test_project slow-services
+    echo "shell_engine: pool" > .ads_profile.yml
+    assert_ok "ads up -j 4 fine" "alpha" "delta"
+    assert_ok "ads status -v fine" "alpha: ok" "delta: ok"
+    assert_fails "ads up broken" "broken on purpose"
+    assert_ok "ads down -j 4"
+}
+
 source "$(dirname "${BASH_SOURCE[0]}")"/util/Framework.sh
\ No newline at end of file
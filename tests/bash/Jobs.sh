@@ -0,0 +1,63 @@
+#!/usr/bin/env bash
+
+test_jobs_run_concurrently() {
+    go_test_project slow-services
+
+    local start="$(date +%s)"
+    assert_ok "ads up -j 4 fine" "Starting alpha" "Starting delta"
+    local elapsed="$(($(date +%s) - start))"
+    # Sequentially this takes 4s
+    if [[ "$elapsed" -ge 3 ]]; then
+        fail "ads up -j 4 took ${elapsed}s"
+    fi
+
+    assert_ok "ads status --jobs 4 fine" "alpha: ok" "delta: ok"
+    assert_ok "ads down -j 4 fine" "Stopping alpha" "Stopping delta"
+}
+
+test_jobs_output_is_in_service_order() {
+    go_test_project slow-services
+
+    local output="$(ads up -j 4 fine)"
+    assert_equal "$output" "$(ads down fine > /dev/null; ads up fine)"
+}
+
+test_jobs_from_profile_and_project() {
+    go_test_project slow-services
+    echo "jobs: 4" >> adsroot.yml
+
+    local start="$(date +%s)"
+    assert_ok "ads up fine"
+    local elapsed="$(($(date +%s) - start))"
+    if [[ "$elapsed" -ge 3 ]]; then
+        fail "ads up with jobs: 4 took ${elapsed}s"
+    fi
+
+    assert_fails "ads up -j 0 fine" "at least 1"
+}
+
+test_jobs_failures_are_reported_per_service() {
+    go_test_project slow-services
+
+    local output
+    output="$(ads up -j 8 all 2>&1)" && fail "up should have failed"
+    assert_contains "$output" \
+        "Failed to start broken" "broken on purpose" \
+        "failed to start: broken" "Starting delta"
+    assert_fails_with_stdout "ads status -j 8 all" "broken: not running"
+}
+
+test_verbose_output_is_prefixed_by_service() {
+    go_test_project slow-services
+
+    local output="$(ads up -v -j 4 fine)"
+    assert_contains "$output" "| sleep 1 && touch started"
+    local echoed_cmds="$(echo "$output" | grep "touch started")"
+    assert_equal "$(echo "$echoed_cmds" | wc -l | tr -d ' ')" "4"
+    assert_equal "$(echo "$echoed_cmds" | grep -c "| ")" "4"
+    for svc in alpha bravo charlie delta; do
+        assert_contains "$echoed_cmds" "$svc"
+    done
+}
+
+source "$(dirname "${BASH_SOURCE[0]}")"/util/Framework.sh
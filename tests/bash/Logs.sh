@@ -6,30 +6,44 @@ test_logs_default() {
 
     # Start service to create logs
     ads up service
+    sleep 1
 
     local logs_output="$(mktemp)"
 
     ads logs service > "$logs_output" &
     local pid="$!"
     sleep 1
-    echo "Looking for expected tail output"
-    grep "==> service/logs/stdout <==" "$logs_output"
-    grep "==> service/logs/stderr <==" "$logs_output"
+    echo "Looking for expected log lines"
+    grep "service.* | .*some output from the service" "$logs_output"
+    grep "service.* | .*some errors from the service" "$logs_output"
     kill -9 "$pid"
+}
+
+test_logs_tail() {
+    test_logs_default
+}
+
+test_logs_follow_new_and_truncated_files() {
+    go_test_project one-trivial-service
+    echo "old output" > service/logs/stdout
+
+    local logs_output="$(mktemp)"
 
-    # tail args are cwd-relative
-    cd service/logs
     ads logs service > "$logs_output" &
     local pid="$!"
     sleep 1
-    echo "Looking for expected tail output"
-    grep "==> stdout <==" "$logs_output"
-    grep "==> stderr <==" "$logs_output"
+    echo "new output" >> service/logs/stdout
+    echo "a new file" > service/logs/stderr
+    sleep 0.5
+    echo "after truncation" > service/logs/stdout
+    sleep 1.5
     kill -9 "$pid"
-}
 
-test_logs_tail() {
-    test_logs_default
+    cat "$logs_output"
+    grep "old output" "$logs_output"
+    grep "new output" "$logs_output"
+    grep "a new file" "$logs_output"
+    grep "after truncation" "$logs_output"
 }
 
 test_list_logs() {
@@ -57,21 +71,162 @@ stderr"
 
 test_cat_logs() {
     go_test_project one-trivial-service
+    printf "out 1\nout 2\n" > service/logs/stdout
+    printf "err 1\n" > service/logs/stderr
 
-    # Start service to create logs
-    ads up service
+    assert_equal "$(ads logs --cat service)" "out 1
+out 2
+err 1"
+
+    # To a pipe, to a file, and with headers (which are cwd-relative)
+    assert_equal "$(ads logs --cat service | cat)" "$(ads logs --cat service)"
+    ads logs --cat service > "$test_tmp/cat_output"
+    assert_equal "$(cat "$test_tmp/cat_output")" "$(ads logs --cat service)"
+    cd service/logs
+    assert_equal "$(ads logs --cat --headers service)" "==> stdout <==
+out 1
+out 2
+
+==> stderr <==
+err 1"
+}
+
+test_cat_logs_range() {
+    go_test_project one-trivial-service
+    printf "0123456789" > service/logs/stdout
+    printf "abc" > service/logs/stderr
+
+    assert_equal "$(ads logs --cat --range 2:5 service)" "234c"
+    assert_equal "$(ads logs --cat --range 8: service)" "89"
+    assert_equal "$(ads logs --cat --range :2 service)" "01ab"
+    assert_fails "ads logs --cat --range 5:2" "backwards"
+    assert_fails "ads logs --range 1:2" "only work with --cat"
+}
+
+test_last_lines_and_bytes() {
+    go_test_project one-trivial-service
+    printf "out 1\nout 2\nout 3\n" > service/logs/stdout
+    printf "err 1\nerr 2" > service/logs/stderr
+
+    assert_equal "$(ads logs --last 2 service)" "==> service/logs/stdout <==
+out 2
+out 3
+
+==> service/logs/stderr <==
+err 1
+err 2"
+    assert_equal "$(ads logs --bytes 3 service)" "==> service/logs/stdout <==
+ 3
+
+==> service/logs/stderr <==
+r 2"
+    assert_fails "ads logs --last -1" "can't be negative"
+}
+
+test_merged_logs() {
+    go_test_project slow-services
+    cat > alpha/ads.yml << EOF
+log_paths: [alpha.log]
+EOF
+    cat > bravo/ads.yml << EOF
+log_paths: [bravo.log]
+log_timestamp_format: "%d/%m/%Y %H:%M:%S"
+EOF
+    printf "2020-01-01 10:00:00.5 alpha first\n" > alpha/alpha.log
+    printf "2020-01-01 10:00:02 alpha third\n" >> alpha/alpha.log
+    printf "  with a continuation line\n" >> alpha/alpha.log
+    printf "01/01/2020 10:00:01 bravo second\n" > bravo/bravo.log
+    printf "01/01/2020 10:00:03 bravo fourth\n" >> bravo/bravo.log
+
+    local merged="$(ads logs --cat --merge alpha bravo | sed 's/.*| //')"
+    assert_equal "$merged" "2020-01-01 10:00:00.5 alpha first
+01/01/2020 10:00:01 bravo second
+2020-01-01 10:00:02 alpha third
+  with a continuation line
+01/01/2020 10:00:03 bravo fourth"
+
+    local logs_output="$(mktemp)"
+    ads logs --merge alpha bravo > "$logs_output" &
+    local pid="$!"
     sleep 1
+    kill -9 "$pid"
+    assert_equal "$(sed 's/.*| //' "$logs_output")" "$merged"
 
-    # ads logs cat actually prints the cat command
-    assert_contains \
-        "$(ads logs --cat service)" \
-        "cat service/logs/stdout service/logs/stderr"
+    assert_fails "ads logs --last 3 --merge" "--merge only works"
+}
 
-    # cat args are cwd-relative
-    cd service/logs
-    assert_contains \
-        "$(ads logs --cat service)" \
-        "cat stdout stderr"
+test_logs_since_and_until() {
+    go_test_project one-trivial-service
+    for minute in 10 20 30 40; do
+        echo "2020-01-01 10:$minute:00 out at $minute" >> service/logs/stdout
+    done
+    echo "2020-01-01 10:25:00 err at 25" > service/logs/stderr
+
+    assert_equal \
+        "$(ads logs --cat --since '2020-01-01 10:15' --until '2020-01-01 10:30')" \
+        "2020-01-01 10:20:00 out at 20
+2020-01-01 10:30:00 out at 30
+2020-01-01 10:25:00 err at 25"
+    assert_equal "$(ads logs --cat --merge --since '2020-01-01 10:15' \
+                        --until '2020-01-01 10:30' | sed 's/.*| //')" \
+        "2020-01-01 10:20:00 out at 20
+2020-01-01 10:25:00 err at 25
+2020-01-01 10:30:00 out at 30"
+
+    # The index goes in the cache, not next to the logs
+    assert_equal "$(ls service/logs)" "other_err
+stderr
+stdout"
+    test -d .ads_cache/log_index
+
+    assert_equal "$(ads logs --cat --since 1h)" ""
+    assert_fails "ads logs --cat --since yesterday" "--since must be a time"
+    assert_fails "ads logs --since 1h" "only work with --cat"
+}
+
+test_grep_logs() {
+    go_test_project one-trivial-service
+    printf "starting\nERROR timed out\nfine\n" > service/logs/stdout
+    printf "ERROR refused\n" > service/logs/stderr
+    printf "ERROR in other_err\n" > service/logs/other_err
+
+    local found="$(ads logs --grep 'ERROR \w+ed')"
+    assert_contains "$found" "service/logs/stdout:2:ERROR timed out" \
+        "service/logs/stderr:1:ERROR refused"
+    assert_not_contains "$found" "starting" "other_err"
+    assert_contains "$(ads logs --grep ERROR --errors)" \
+        "service/logs/other_err:1:ERROR in other_err"
+
+    # Exit statuses are like grep's
+    local status=0
+    ads logs --grep "no such line" || status=$?
+    assert_equal "$status" 1
+    status=0
+    ads logs --grep "(unbalanced" || status=$?
+    assert_equal "$status" 2
+}
+
+test_rotated_logs() {
+    go_test_project one-trivial-service
+    printf "2015-06-01 10:00:00 oldest\n" | bzip2 > service/logs/stdout.3.bz2
+    printf "2015-06-01 11:00:00 older\n" | gzip > service/logs/stdout.2.gz
+    printf "2015-06-01 12:00:00 old\n" > service/logs/stdout.1
+    printf "2015-06-01 13:00:00 new\n" > service/logs/stdout
+
+    assert_equal "$(ads logs --list)" "$(printf "%s\n" \
+        service/logs/stdout.3.bz2 service/logs/stdout.2.gz \
+        service/logs/stdout.1 service/logs/stdout)"
+    assert_equal "$(ads logs --cat)" "$(printf "%s\n" \
+        "2015-06-01 10:00:00 oldest" "2015-06-01 11:00:00 older" \
+        "2015-06-01 12:00:00 old" "2015-06-01 13:00:00 new")"
+    assert_contains "$(ads logs --grep older)" \
+        "service/logs/stdout.2.gz:1:2015-06-01 11:00:00 older"
+    assert_equal "$(ads logs --cat --since '2015-06-01 10:30' \
+        --until '2015-06-01 11:30')" "2015-06-01 11:00:00 older"
+    assert_contains "$(ads logs --cat --merge)" "oldest" "new"
+
+    # Following and --last only look at the live log
+    assert_not_contains "$(ads logs --last 5)" "old"
 }
 
 test_logs_commands_when_logs_missing() {
@@ -87,7 +242,7 @@ test_logs_commands_when_some_logs_missing() {
     touch burger/burger.log
 
     assert_ok "ads logs --list" "burger.log"
-    assert_ok "ads logs --cat" "burger.log"
+    assert_ok "ads logs --cat --headers" "burger.log"
 }
 
 test_general_vs_error_logs() {
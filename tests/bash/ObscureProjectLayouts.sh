@@ -70,4 +70,105 @@ test_nested_projects_and_services() {
     assert_contains "$(ads home all)" "pepperoni"
 }
 
+test_manifest_tracks_added_changed_and_removed_services() {
+    go_test_project interesting-hierarchy
+
+    assert_ok "ads list" "burger"
+    assert_not_contains "$(ads list)" "onion"
+
+    mkdir onion
+    echo "description: Rings" > onion/ads.yml
+    assert_contains "$(ads list)" "onion: Rings"
+
+    echo "description: Rings, but battered" > onion/ads.yml
+    assert_contains "$(ads list)" "onion: Rings, but battered"
+
+    # Replaced by a file with the same size and mtime (say, by a checkout)
+    touch -d "2015-06-01" onion/ads.yml
+    assert_contains "$(ads list)" "onion: Rings, but battered"
+    echo "description: Rings, and battered" > onion/ads.yml.new
+    touch -r onion/ads.yml onion/ads.yml.new
+    mv onion/ads.yml.new onion/ads.yml
+    assert_contains "$(ads list)" "onion: Rings, and battered"
+
+    rm -r onion
+    assert_not_contains "$(ads list)" "onion"
+
+    # Even a corrupt manifest just means a rescan
+    echo "garbage" > .ads_cache/manifest
+    assert_contains "$(ads list)" "burger" "fries" "western"
+    assert_contains "$(ads list --rescan)" "burger" "fries" "western"
+}
+
+test_only_needed_specs_are_parsed() {
+    go_test_project interesting-hierarchy
+    echo "start_cmd: [oops" > fries/ads.yml
+
+    # A broken service only gets in the way of commands that use it
+    assert_ok "ads home burger" "burger"
+    assert_ok "ads status burger" "burger: ok"
+    assert_fails "ads status fries" "expected ',' or ']'"
+    assert_fails "ads list" "expected ',' or ']'"
+    assert_fails "ads status all" "expected ',' or ']'"
+}
+
+test_pruned_and_ignored_dirs() {
+    go_test_project interesting-hierarchy
+
+    mkdir -p node_modules/left-pad .git/hooks data/huge/stuff pizzeria
+    echo "description: nope" > node_modules/left-pad/ads.yml
+    echo "description: nope" > .git/hooks/ads.yml
+    echo "description: nope" > data/huge/stuff/ads.yml
+    echo "description: Not part of the pizza project" > pizzeria/ads.yml
+    printf "# comment\ndata/huge\n" > .adsignore
+
+    local listing="$(ads list)"
+    assert_contains "$listing" "burger" "fries" "western" "pizzeria"
+    assert_not_contains "$listing" "left-pad" "hooks" " stuff"
+
+    # Un-ignoring takes effect without --rescan
+    printf "!node_modules\n" > .adsignore
+    listing="$(ads list)"
+    assert_contains "$listing" "left-pad" " stuff"
+}
+
+test_git_discovery() {
+    go_test_project interesting-hierarchy
+    git init -q .
+    mkdir -p build/generated
+    echo "description: build output" > build/generated/ads.yml
+    echo "build" > .gitignore
+
+    # Ignored by git, so not a service
+    local listing="$(ads list)"
+    assert_contains "$listing" "burger" "fries" "western"
+    assert_not_contains "$listing" "generated" "pepperoni"
+
+    # Unless we insist on walking the tree
+    echo "discovery: walk" > adsroot.yml
+    assert_contains "$(ads list)" "generated"
+
+    echo "discovery: sideways" > adsroot.yml
+    assert_fails "ads list" "discovery must be one of"
+}
+
+test_git_discovery_falls_back_to_walking() {
+    go_test_project interesting-hierarchy
+
+    # Another repository inside the project: git won't list its files
+    git init -q .
+    git init -q burger
+    assert_contains "$(ads list)" "burger" "western" "fries"
+
+    # A project that the enclosing repository ignores
+    rm -rf .git burger/.git
+    mkdir -p outer/scratch
+    mv burger fries adsroot.yml outer/scratch
+    git init -q outer
+    echo "scratch" > outer/.gitignore
+    cd outer/scratch
+    assert_contains "$(ads list)" "burger" "western" "fries"
+    assert_ok "ads home fries"
+}
+
 source "$(dirname "${BASH_SOURCE[0]}")"/util/Framework.sh
\ No newline at end of file
@@ -28,6 +28,45 @@ EOF
         "europe: ireland"
 }
 
+test_selector_operators() {
+    go_test_project interesting-selectors
+    set_ads_profile << EOF
+groups:
+    not-canada:
+    - all
+    - -canada
+    jays:
+    - canada
+    hosers:
+    - canada
+    v-canada:
+    - canada
+EOF
+
+    local status="$(ads status all -north-america)"
+    assert_contains "$status" "ireland"
+    assert_not_contains "$status" "america" "canada"
+
+    status="$(ads status "north-america&not-canada")"
+    assert_contains "$status" "america"
+    assert_not_contains "$status" "canada" "ireland"
+
+    status="$(ads status -v "canada|ireland")"
+    assert_contains "$status" "canada" "ireland"
+    assert_not_contains "$status" "america"
+
+    # Exclusions that start like an option (-j, -h, -v) are still exclusions
+    for excluded in -jays -hosers -v-canada; do
+        status="$(ads status all $excluded)"
+        assert_contains "$status" "ireland"
+        assert_not_contains "$status" "canada"
+    done
+    assert_contains "$(ads status -v -j2 canada)" "canada"
+
+    assert_fails "ads status all --bogus" "unrecognized arguments: --bogus"
+    assert_fails "ads status canada&" "Bad selector"
+}
+
 test_default_selector_is_all_when_none_defined() {
     go_test_project one-trivial-service
 
@@ -0,0 +1,62 @@
+import os
+import shutil
+import tempfile
+import unittest
+from ads.ads import Ads, Project, LazyService, _load_spec_file, \
+    _parse_spec_job
+
+
+class TestLazyServices(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.parsed = []
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _yml(self, rel_path, text):
+        path = os.path.join(self.dir, rel_path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            f.write(text)
+        return path
+
+    def _load_spec(self, path):
+        self.parsed.append(os.path.relpath(path, self.dir))
+        return _load_spec_file(path)
+
+    def _project(self):
+        return Project.load_from_files(
+            self._yml("adsroot.yml", ""),
+            [self._yml("a/ads.yml", "description: Aye"),
+             self._yml("b/ads.yml", "start_cmd: [oops")],
+            self._load_spec)
+
+    def test_parsed_on_first_use(self):
+        project = self._project()
+        a = project.services_by_name["a"]
+        self.assertTrue(isinstance(a, LazyService))
+        self.assertEqual((a.name, a.home), ("a", os.path.join(self.dir, "a")))
+        self.assertEqual(self.parsed, ["adsroot.yml"])
+
+        self.assertEqual(a.get_description_or_default(), "Aye")
+        self.assertEqual(a.description, "Aye")
+        self.assertEqual(self.parsed, ["adsroot.yml", "a/ads.yml"])
+
+    def test_only_selected_services_are_loaded(self):
+        ads = Ads(self._project())
+        self.assertEqual(ads.resolve("all"), frozenset(["a", "b"]))
+        project = ads.project
+        project.load_services([project.services_by_name["a"]])
+        self.assertEqual(self.parsed, ["adsroot.yml", "a/ads.yml"])
+        self.assertRaises(Exception, project.load_services,
+                          project.services_by_name.values())
+
+    def test_parse_spec_job(self):
+        path = self._yml("a/ads.yml", "description: Aye")
+        self.assertEqual(_parse_spec_job(path),
+                         (path, {"description": "Aye"}))
+        path = self._yml("b/ads.yml", "start_cmd: [oops")
+        self.assertEqual(_parse_spec_job(path), (path, None))
@@ -0,0 +1,120 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+from ads.ads import LogFollower, TimestampParser, _last_lines_offset
+
+
+class TestLogFollower(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.dir, "log")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _write(self, text, mode="a"):
+        with open(self.log, mode) as f:
+            f.write(text)
+
+    def test_starts_at_end(self):
+        self._write("old\n")
+        follower = LogFollower(lambda: [self.log])
+        self.assertEqual(follower.read_lines(), [])
+        self._write("new\n")
+        self.assertEqual(follower.read_lines(), [(self.log, ["new"])])
+
+    def test_file_created_later(self):
+        follower = LogFollower(lambda: [self.log])
+        self.assertEqual(follower.read_lines(), [])
+        self._write("hello\n")
+        self.assertEqual(follower.read_lines(), [(self.log, ["hello"])])
+
+    def test_partial_lines_wait_for_newline(self):
+        follower = LogFollower(lambda: [self.log])
+        self._write("hel")
+        self.assertEqual(follower.read_lines(), [])
+        self._write("lo\nwor")
+        self.assertEqual(follower.read_lines(), [(self.log, ["hello"])])
+
+    def test_truncated(self):
+        self._write("a long line from the last run\n")
+        follower = LogFollower(lambda: [self.log])
+        self._write("new run\n", "w")
+        self.assertEqual(follower.read_lines(), [(self.log, ["new run"])])
+
+    def test_truncated_and_rewritten_past_offset(self):
+        self._write("listening on 1\n")
+        follower = LogFollower(lambda: [self.log])
+        self._write("ready\nlistening on 2\n", "w")
+        self.assertEqual(follower.read_lines(),
+                         [(self.log, ["ready", "listening on 2"])])
+        self._write("more\n")
+        self.assertEqual(follower.read_lines(), [(self.log, ["more"])])
+
+    def test_replaced(self):
+        self._write("old\n")
+        follower = LogFollower(lambda: [self.log])
+        os.rename(self.log, self.log + ".1")
+        self._write("newer and longer\n")
+        self.assertEqual(follower.read_lines(),
+                         [(self.log, ["newer and longer"])])
+
+    def test_rotated_tail_is_not_lost(self):
+        self._write("one\ntwo\n")
+        follower = LogFollower(lambda: [self.log])
+        self._write("three\n")
+        os.rename(self.log, self.log + ".1")
+        self._write("four\n")
+        self.assertEqual(follower.read_lines(),
+                         [(self.log, ["three", "four"])])
+        self.assertEqual(follower.read_lines(), [])
+
+    def test_backlog(self):
+        self._write("".join("line %d\n" % i for i in range(5000)))
+        follower = LogFollower(lambda: [self.log], backlog_lines=3)
+        self.assertEqual(follower.read_lines(),
+                         [(self.log, ["line 4997", "line 4998", "line 4999"])])
+
+    def test_backlog_without_final_newline(self):
+        self._write("one\ntwo\nthree")
+        follower = LogFollower(lambda: [self.log], backlog_lines=2)
+        self._write("\n")
+        self.assertEqual(follower.read_lines(), [(self.log, ["two", "three"])])
+
+    def test_backlog_longer_than_file(self):
+        self._write("one\ntwo\n")
+        follower = LogFollower(lambda: [self.log], backlog_lines=10)
+        self.assertEqual(follower.read_lines(), [(self.log, ["one", "two"])])
+
+    def test_last_lines_offset(self):
+        self._write("".join("line %d\n" % i for i in range(100000)))
+        fd = os.open(self.log, os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            offset = _last_lines_offset(fd, size, 20000)
+            os.lseek(fd, offset, os.SEEK_SET)
+            self.assertTrue(os.read(fd, 11).startswith("line 80000\n"))
+            self.assertEqual(_last_lines_offset(fd, size, 0), size)
+            self.assertEqual(_last_lines_offset(fd, size, 10 ** 6), 0)
+        finally:
+            os.close(fd)
+
+
+class TestTimestampParser(unittest.TestCase):
+
+    def test_default_formats(self):
+        parser = TimestampParser()
+        self.assertEqual(parser.parse("2020-01-02T03:04:05 hello"),
+                         datetime.datetime(2020, 1, 2, 3, 4, 5))
+        self.assertEqual(parser.parse("2020-01-02 03:04:05,25 hello"),
+                         datetime.datetime(2020, 1, 2, 3, 4, 5, 250000))
+        self.assertEqual(parser.parse("    at Foo.bar(Foo.java:12)"), None)
+
+    def test_custom_formats(self):
+        parser = TimestampParser(["[%d/%b/%Y:%H:%M:%S]"])
+        self.assertEqual(parser.parse("[10/Oct/2000:13:55:36] GET /"),
+                         datetime.datetime(2000, 10, 10, 13, 55, 36))
+        self.assertEqual(parser.parse("2020-01-02 03:04:05 hello"), None)
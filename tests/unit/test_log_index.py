@@ -0,0 +1,79 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+from ads import ads
+from ads.ads import LogIndex
+
+
+def _line(minute, text="hello"):
+    return "2020-01-01 10:%02d:00 %s\n" % (minute, text)
+
+
+class TestLogIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.dir, "cache")
+        self.log = os.path.join(self.dir, "log")
+        self.old_every = ads.LOG_INDEX_EVERY
+        ads.LOG_INDEX_EVERY = 3
+
+    def tearDown(self):
+        ads.LOG_INDEX_EVERY = self.old_every
+        shutil.rmtree(self.dir)
+
+    def _write(self, text, mode="a"):
+        with open(self.log, mode) as f:
+            f.write(text)
+
+    def _window(self, since=None, until=None):
+        index = LogIndex.open(self.cache_dir, self.log, None)
+        (start, end) = index.find(since, until)
+        with open(self.log) as f:
+            return f.read()[start:end]
+
+    def test_find(self):
+        self._write("".join(_line(m) for m in range(30)))
+        self._write("  continued\n")
+        self.assertEqual(
+            self._window(datetime.datetime(2020, 1, 1, 10, 10),
+                         datetime.datetime(2020, 1, 1, 10, 12)),
+            _line(10) + _line(11) + _line(12))
+        self.assertEqual(
+            self._window(datetime.datetime(2020, 1, 1, 10, 29)),
+            _line(29) + "  continued\n")
+        self.assertEqual(
+            self._window(until=datetime.datetime(2020, 1, 1, 10, 0, 30)),
+            _line(0))
+        self.assertEqual(
+            self._window(datetime.datetime(2020, 1, 1, 11)), "")
+
+    def test_index_is_saved_and_extended(self):
+        self._write("".join(_line(m) for m in range(10)))
+        index = LogIndex.open(self.cache_dir, self.log, None)
+        entries = list(index.entries)
+        self._write(_line(10) + _line(11) + _line(12))
+        index = LogIndex.open(self.cache_dir, self.log, None)
+        self.assertEqual(index.entries[:len(entries)], entries)
+        self.assertTrue(len(index.entries) > len(entries))
+        self.assertEqual(
+            self._window(datetime.datetime(2020, 1, 1, 10, 12)), _line(12))
+
+    def test_truncated_and_rotated(self):
+        self._write("".join(_line(m) for m in range(10)))
+        LogIndex.open(self.cache_dir, self.log, None)
+
+        # Truncated, then grown past the old size
+        self._write("".join(_line(m, "new!") for m in range(20)), "w")
+        self.assertEqual(
+            self._window(datetime.datetime(2020, 1, 1, 10, 5),
+                         datetime.datetime(2020, 1, 1, 10, 5)),
+            _line(5, "new!"))
+
+        os.rename(self.log, self.log + ".1")
+        self._write(_line(5, "newer"))
+        self.assertEqual(
+            self._window(datetime.datetime(2020, 1, 1, 10, 5)),
+            _line(5, "newer"))
@@ -0,0 +1,82 @@
+import os
+import tempfile
+import unittest
+from ads.ads import _required_literal, _grep_file
+
+
+class TestRequiredLiteral(unittest.TestCase):
+
+    def test_literals(self):
+        self.assertEqual(_required_literal("connection refused"),
+                         "connection refused")
+        self.assertEqual(_required_literal("took \\d+ms to connect"),
+                         "ms to connect")
+        self.assertEqual(_required_literal("^ERROR .* timed out$"),
+                         " timed out")
+        self.assertEqual(_required_literal("v1\\.2"), "v1.2")
+
+    def test_optional_parts_are_not_required(self):
+        self.assertEqual(_required_literal("colou?r"), "colo")
+        self.assertEqual(_required_literal("(bad )?request"), "request")
+        self.assertEqual(_required_literal("[Ee]rror"), "rror")
+
+    def test_give_up_when_unsure(self):
+        self.assertEqual(_required_literal("foo|bar"), "")
+        self.assertEqual(_required_literal("(?i)error"), "")
+
+    def test_repeats_escapes_and_classes_are_not_literal(self):
+        self.assertEqual(_required_literal("a{2}b"), "b")
+        self.assertEqual(_required_literal("x{3}"), "")
+        self.assertEqual(_required_literal("\\x41BC"), "ABC")
+        self.assertEqual(_required_literal("\\101"), "A")
+        self.assertEqual(_required_literal("[^]]"), "")
+        self.assertEqual(_required_literal("[]a]bc"), "bc")
+
+
+class TestGrepFile(unittest.TestCase):
+
+    def setUp(self):
+        self.log = tempfile.NamedTemporaryFile()
+        self.log.write("starting\n"
+                       "ERROR 1 timed out\n"
+                       "fine\n"
+                       "ERROR 2 refused\n"
+                       "ERROR 3 timed out")
+        self.log.flush()
+
+    def tearDown(self):
+        self.log.close()
+
+    def test_with_literal(self):
+        self.assertEqual(
+            _grep_file((self.log.name, "ERROR \\d timed", " timed")),
+            (self.log.name,
+             [(2, "ERROR 1 timed out"), (5, "ERROR 3 timed out")],
+             None))
+
+    def test_without_literal(self):
+        self.assertEqual(
+            _grep_file((self.log.name, "^(fine|starting)$", "")),
+            (self.log.name, [(1, "starting"), (3, "fine")], None))
+
+    def test_missing_file(self):
+        (path, matches, problem) = _grep_file(("/nonexistent", "x", "x"))
+        self.assertEqual(matches, [])
+        self.assertTrue(problem)
+
+    def test_prefilter_keeps_every_match(self):
+        log = tempfile.NamedTemporaryFile()
+        log.write("xaab\nABC\nxxx\n")
+        log.flush()
+        for (pattern, expected) in [("a{2}b", [(1, "xaab")]),
+                                    ("\\x41BC", [(2, "ABC")]),
+                                    ("x{3}", [(3, "xxx")]),
+                                    ("[^]]b", [(1, "xaab")])]:
+            self.assertEqual(
+                _grep_file((log.name, pattern, _required_literal(pattern))),
+                (log.name, expected, None))
+
+    def test_empty_file(self):
+        empty = tempfile.NamedTemporaryFile()
+        self.assertEqual(_grep_file((empty.name, "x", "x")),
+                         (empty.name, [], None))
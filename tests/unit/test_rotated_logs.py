@@ -0,0 +1,80 @@
+import bz2
+import datetime
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+from ads.ads import _with_rotated, _Inflater, Inflaters, _iter_lines, \
+    _slice_chunks, _TimeWindow, TimestampParser
+
+
+class TestRotatedLogs(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _touch(self, *names):
+        for name in names:
+            open(os.path.join(self.dir, name), "w").close()
+        return [os.path.join(self.dir, name) for name in names]
+
+    def test_order(self):
+        self._touch("app.log.1", "app.log.2.gz", "app.log.10.bz2",
+                    "app.log-20150602", "app.log-20150601.zst",
+                    "app.log.old", "app.logger", "other.log.1")
+        [log] = self._touch("app.log")
+        self.assertEqual(
+            [os.path.basename(p) for p in _with_rotated([log])],
+            ["app.log.10.bz2", "app.log.2.gz", "app.log.1",
+             "app.log-20150601.zst", "app.log-20150602", "app.log"])
+
+    def test_rotated_files_matched_directly(self):
+        paths = self._touch("app.log", "app.log.1")
+        self.assertEqual(_with_rotated(paths), list(reversed(paths)))
+        self.assertEqual(_with_rotated(list(reversed(paths))),
+                         list(reversed(paths)))
+
+    def test_decompression(self):
+        text = "".join("line %d\n" % i for i in range(100000))
+        gz = os.path.join(self.dir, "a.gz")
+        f = gzip.open(gz, "wb")
+        f.write(text)
+        f.close()
+        bz = os.path.join(self.dir, "b.bz2")
+        f = bz2.BZ2File(bz, "wb")
+        f.write(text)
+        f.close()
+
+        inflaters = Inflaters([gz, bz])
+        for path in [gz, bz]:
+            self.assertEqual("".join(inflaters.chunks(path)), text)
+
+        [bogus] = self._touch("bogus.gz")
+        with open(bogus, "w") as f:
+            f.write("not really gzip")
+        inflater = _Inflater(bogus)
+        inflater.start()
+        self.assertRaises(IOError, list, inflater.chunks())
+
+    def test_iter_lines(self):
+        self.assertEqual(list(_iter_lines(["a\nb", "c\n", "\nd"])),
+                         ["a\n", "bc\n", "\n", "d"])
+
+    def test_slice_chunks(self):
+        chunks = ["abc", "def", "ghi"]
+        self.assertEqual("".join(_slice_chunks(chunks, 2, 7)), "cdefg")
+        self.assertEqual("".join(_slice_chunks(chunks, 4, None)), "efghi")
+        self.assertEqual("".join(_slice_chunks(chunks, 0, 0)), "")
+
+    def test_time_window(self):
+        lines = ["2020-01-01 10:%02d:00 hi\n" % m for m in range(10)]
+        lines.insert(5, "  continued\n")
+        window = _TimeWindow(TimestampParser(None),
+                             datetime.datetime(2020, 1, 1, 10, 3),
+                             datetime.datetime(2020, 1, 1, 10, 4))
+        self.assertEqual([line for (_, line) in window.select(lines)],
+                         [lines[3], lines[4], lines[5]])
@@ -1,5 +1,6 @@
 import unittest
 from ads import Ads, Project, Service, ServiceSet, Profile, BadSelectorException
+from ads.ads import SelectorGraph
 
 some_services = [Service("a", "/a"),
                  Service("b", "/b"),
@@ -76,6 +77,60 @@ class TestSelectors(unittest.TestCase):
             BadSelectorException, "bar -> foo -> bar", ads.resolve, "bar")
         pass
 
+    def test_selector_leading_to_a_cycle(self):
+        ads = Ads(Project("test", "/test", some_services,
+                          [ServiceSet("foo", ["a", "bar"]),
+                           ServiceSet("bar", ["baz"]),
+                           ServiceSet("baz", ["bar"]),
+                           ServiceSet("fine", ["a", "b"])]))
+        self.assertRaisesRegexp(
+            BadSelectorException, "'foo' is circular: foo -> bar -> baz -> bar",
+            ads.resolve, "foo")
+        # The cycle doesn't get in the way of anything else
+        self.assertEqual(ads.resolve("fine"), frozenset(["a", "b"]))
+
+    def test_shared_groups_are_resolved_once(self):
+        # A diamond: top -> left, right -> base
+        graph = SelectorGraph(
+            Project("test", "/test", some_services),
+            [ServiceSet("base", ["a", "b"]),
+             ServiceSet("left", ["base", "c"]),
+             ServiceSet("right", ["base", "d"]),
+             ServiceSet("top", ["left", "right"])])
+        self.assertEqual(graph.resolve("top"),
+                         frozenset(["a", "b", "c", "d"]))
+        # Services a..d are bits 0..3
+        self.assertEqual(graph.resolved["base"], 0b0011)
+        self.assertEqual(graph.resolved["left"], 0b0111)
+        self.assertEqual(graph.resolved["right"], 0b1011)
+        self.assertEqual(graph.resolve_bits("top"), 0b1111)
+
+    def test_set_algebra(self):
+        ads = Ads(Project("test", "/test", some_services,
+                          [a_and_b, b_and_c,
+                           ServiceSet("not-b", ["all", "-b"]),
+                           ServiceSet("ends", ["a|d"])],
+                          "all -a"))
+        self.assertEqual(ads.resolve("all -a-and-b"), frozenset(["c", "d"]))
+        self.assertEqual(ads.resolve("a-and-b&b-and-c"), frozenset(["b"]))
+        self.assertEqual(ads.resolve("a|c d"), frozenset(["a", "c", "d"]))
+        self.assertEqual(ads.resolve("a-and-b|d&b-and-c"),
+                         frozenset(["a", "b"]))
+        self.assertEqual(ads.resolve("not-b"), frozenset(["a", "c", "d"]))
+        self.assertEqual(ads.resolve("ends -a"), frozenset(["d"]))
+        self.assertEqual(ads.resolve("default -d"), frozenset(["b", "c"]))
+        self.assertEqual(ads.resolve("-a"), frozenset())
+        for bad in ["a&", "|b", "-", "a&&b"]:
+            self.assertRaisesRegexp(
+                BadSelectorException, "Bad selector", ads.resolve, bad)
+
+    def test_deeply_layered_groups(self):
+        layers = [ServiceSet("layer0", ["a"])] + [
+            ServiceSet("layer%d" % i, ["layer%d" % (i - 1), "b"])
+            for i in range(1, 5000)]
+        ads = Ads(Project("test", "/test", some_services, layers))
+        self.assertEqual(ads.resolve("layer4999"), frozenset(["a", "b"]))
+
     def test_default_selector_when_defined_in_project(self):
         self.assertEqual(
             Ads(Project("test", "/test", some_services, [], "b"))
@@ -0,0 +1,62 @@
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from ads import ads
+from ads.ads import _shell, BUFFER, STREAM
+
+CHATTY = "(for i in $(seq 1000); do echo x; sleep 0.005; done) & echo started"
+
+
+class TestShellOutput(unittest.TestCase):
+
+    def test_buffer_doesnt_wait_for_background_output(self):
+        start = time.time()
+        (status, output) = _shell(CHATTY, "/", BUFFER)
+        self.assertEqual(status, 0)
+        self.assertTrue("\nstarted\n" in output)
+        self.assertTrue(time.time() - start < 2)
+
+
+class TestPrefixedOutput(unittest.TestCase):
+
+    def setUp(self):
+        self.stdout = sys.stdout
+        sys.stdout = tempfile.TemporaryFile()
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+    def _run(self, name, cmd):
+        ads._reports.prefix = name + " | "
+        try:
+            return _shell(cmd, "/", STREAM)
+        finally:
+            ads._reports.prefix = None
+
+    def _output(self):
+        sys.stdout.seek(0)
+        return sys.stdout.read()
+
+    def test_concurrent_commands_lose_nothing(self):
+        threads = [threading.Thread(target=self._run,
+                                    args=("s%d" % i, "seq 5000"))
+                   for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        lines = self._output().splitlines()
+        for i in range(20):
+            self.assertEqual(
+                [l for l in lines if l.startswith("s%d | " % i)][-5000:],
+                ["s%d | %d" % (i, n) for n in range(1, 5001)])
+
+    def test_doesnt_wait_for_background_output(self):
+        start = time.time()
+        (status, _) = self._run("chatty", CHATTY)
+        self.assertEqual(status, 0)
+        self.assertTrue("chatty | started\n" in self._output())
+        self.assertTrue(time.time() - start < 2)
@@ -0,0 +1,42 @@
+import os
+import time
+import unittest
+from ads.ads import ShellPool, BUFFER, NULL
+
+
+class TestShellPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ShellPool(1)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_status_and_output(self):
+        (status, output) = self.pool.run("echo out; echo err >&2; exit 3",
+                                         "/", BUFFER)
+        self.assertEqual(status, 3)
+        self.assertTrue(output.endswith("out\nerr\n"))
+        self.assertEqual(self.pool.run("exit 4", "/", NULL), (4, None))
+
+    def test_background_output_stays_out_of_later_commands(self):
+        (status, output) = self.pool.run(
+            "(sleep 0.2; echo leaked) & echo started", "/", BUFFER)
+        self.assertEqual(status, 0)
+        self.assertTrue(output.endswith("started\n"))
+        time.sleep(0.4)
+        (status, output) = self.pool.run("printf done", "/", BUFFER)
+        self.assertEqual(status, 0)
+        self.assertTrue(output.endswith("done"))
+        self.assertFalse("leaked" in output)
+
+    def test_dead_worker_is_cleaned_up(self):
+        worker = self.pool._checkout()
+        worker.process.kill()
+        worker.process.wait()
+        self.pool._checkin(worker)
+        self.assertFalse(os.path.exists(worker.fifo_dir))
+        self.assertEqual(self.pool.run("exit 5", "/", NULL), (5, None))
+
+    def test_unknown_output_mode(self):
+        self.assertRaises(ValueError, self.pool.run, "true", "/", "bogus")
@@ -0,0 +1,98 @@
+import os
+import socket
+import subprocess
+import tempfile
+import threading
+import unittest
+import BaseHTTPServer
+from ads.ads import StatusCheck, ProcessTable, ParseProjectException
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(self.path == "/health" and 200 or 404)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestStatusCheck(unittest.TestCase):
+
+    def test_pidfile(self):
+        pidfile = tempfile.NamedTemporaryFile()
+        pidfile.write(str(os.getpid()))
+        pidfile.flush()
+        self.assertTrue(StatusCheck(pidfile=pidfile.name).is_running("/"))
+
+        pidfile.seek(0)
+        pidfile.write("garbage")
+        pidfile.flush()
+        self.assertFalse(StatusCheck(pidfile=pidfile.name).is_running("/"))
+        self.assertFalse(StatusCheck(pidfile="/nonexistent").is_running("/"))
+
+    def test_tcp_port(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        port = listener.getsockname()[1]
+        self.assertTrue(
+            StatusCheck(tcp_port=("127.0.0.1", port)).is_running("/"))
+        listener.close()
+        self.assertFalse(
+            StatusCheck(tcp_port=("127.0.0.1", port)).is_running("/"))
+
+    def test_http_url(self):
+        server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), _Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        url = "http://127.0.0.1:%d" % server.server_address[1]
+        try:
+            self.assertTrue(
+                StatusCheck(http_url=url + "/health").is_running("/"))
+            self.assertFalse(
+                StatusCheck(http_url=url + "/other").is_running("/"))
+            self.assertTrue(
+                StatusCheck(http_url=url + "/other",
+                            http_status=404).is_running("/"))
+        finally:
+            server.shutdown()
+
+    def test_every_check_must_pass(self):
+        check = StatusCheck(pidfile="/nonexistent",
+                            process_pattern=".")
+        self.assertFalse(check.is_running("/"))
+
+    def test_load(self):
+        check = StatusCheck.load({"tcp_port": "localhost:8080"}, "ads.yml")
+        self.assertEqual(check.checks[0][0], "tcp_port localhost:8080")
+        self.assertRaises(ParseProjectException,
+                          StatusCheck.load, {}, "ads.yml")
+        self.assertRaises(ParseProjectException,
+                          StatusCheck.load, {"tcp_prot": 80}, "ads.yml")
+        self.assertRaises(ParseProjectException,
+                          StatusCheck.load, {"tcp_port": "80"}, "ads.yml")
+        self.assertRaises(ParseProjectException, StatusCheck.load,
+                          {"tcp_port": "host:abc"}, "ads.yml")
+
+
+class TestProcessTable(unittest.TestCase):
+
+    def test_has_match(self):
+        table = ProcessTable([(1, "/sbin/init"),
+                              (2, "bash ninja.sh --fast"),
+                              (os.getpid(), "python ads status pirate")])
+        self.assertTrue(table.has_match("ninja.sh"))
+        self.assertTrue(table.has_match("ninja[.]sh --f"))
+        self.assertFalse(table.has_match("init.*ninja"))
+        self.assertFalse(table.has_match("pirate"))
+
+    def test_read(self):
+        sleeper = subprocess.Popen(["sleep", "30"])
+        try:
+            table = ProcessTable.read()
+            self.assertTrue((sleeper.pid, "sleep 30") in table.processes)
+        finally:
+            sleeper.kill()
+            sleeper.wait()